@@ -0,0 +1,13 @@
+"""
+Benchmarks for the Indivo admin tool.
+
+Run a benchmark module from the project directory, e.g.:
+
+  DJANGO_SETTINGS_MODULE=settings python -m admin.benchmarks.bench_models
+
+bench_views runs the admin's views against the stand-in Indivo server in standin.py,
+which can also be run on its own:
+
+  python -m admin.benchmarks.standin 8004
+
+"""
@@ -0,0 +1,118 @@
+"""
+Microbenchmark for parsing Contact documents and holding IndivoModel objects.
+
+Compares IndivoContact.from_etree against the eight descendant searches it replaced,
+and the size of the __slots__-based model objects against dict-backed equivalents.
+
+"""
+
+from admin.lib.indivo import IndivoRecord, IndivoAccount, IndivoContact, DOC_NS
+from lxml import etree
+import sys
+import timeit
+
+CONTACT_XML = """
+<Contact xmlns="%s">
+  <name>
+    <fullName>Sebastian Rockwell Cotour</fullName>
+    <givenName>Sebastian</givenName>
+    <familyName>Cotour</familyName>
+  </name>
+  <email type="personal">
+    <emailAddress>scotour@hotmail.com</emailAddress>
+  </email>
+  <email type="work">
+    <emailAddress>sebastian.cotour@childrens.harvard.edu</emailAddress>
+  </email>
+  <address type="home">
+    <streetAddress>15 Waterhill Ct.</streetAddress>
+    <postalCode>53326</postalCode>
+    <locality>New Brinswick</locality>
+    <region>Montana</region>
+    <country>US</country>
+    <timeZone>-7GMT</timeZone>
+  </address>
+  <location type="home">
+    <latitude>47N</latitude>
+    <longitude>110W</longitude>
+  </location>
+  <phoneNumber type="home">5212532532</phoneNumber>
+  <phoneNumber type="work">6217233734</phoneNumber>
+  <instantMessengerName protocol="aim">scotour</instantMessengerName>
+</Contact>
+"""%DOC_NS
+
+def from_etree_by_search(xml_etree):
+    """ The previous IndivoContact.from_etree: one descendant search per field. """
+    contact = IndivoContact()
+    contact.full_name = IndivoContact.find_text_anywhere(xml_etree, 'fullName')
+    contact.given_name = IndivoContact.find_text_anywhere(xml_etree, 'givenName')
+    contact.family_name = IndivoContact.find_text_anywhere(xml_etree, 'familyName')
+    contact.email = IndivoContact.find_text_anywhere(xml_etree, 'emailAddress')
+    contact.street_address  = IndivoContact.find_text_anywhere(xml_etree, 'streetAddress')
+    contact.region = IndivoContact.find_text_anywhere(xml_etree, 'region')
+    contact.postal_code = IndivoContact.find_text_anywhere(xml_etree, 'postalCode')
+    contact.country = IndivoContact.find_text_anywhere(xml_etree, 'country')
+    contact.phone_numbers = IndivoContact.findalltext(xml_etree, '{%s}phoneNumber'%DOC_NS)
+    return contact
+
+class DictRecord(object):
+    def __init__(self, record_id, label):
+        self.record_id = record_id
+        self.label = label
+        self.contact = None
+        self.owner = None
+        self.fullshares = {}
+        self.carenetshares = []
+
+class DictAccount(object):
+    def __init__(self, account_id, full_name):
+        self.account_id = account_id
+        self.full_name = full_name
+        self.contact_email = account_id
+        self.state = 'active'
+        self.secondary_secret = None
+        self.fullshares = {}
+
+def object_size(obj):
+    """ The memory held by an object and its attribute dict, not counting shared values. """
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+def bench_contact_parsing(number=20000):
+    xml_etree = etree.XML(CONTACT_XML)
+    assert vars_of(from_etree_by_search(xml_etree)) == vars_of(IndivoContact.from_etree(xml_etree))
+
+    by_search = min(timeit.repeat(lambda: from_etree_by_search(xml_etree), number=number, repeat=3))
+    single_walk = min(timeit.repeat(lambda: IndivoContact.from_etree(xml_etree), number=number, repeat=3))
+    print "Contact parsing (%s documents):"%number
+    print "  descendant searches: %.3fs (%.1fus each)"%(by_search, by_search / number * 1e6)
+    print "  single walk:         %.3fs (%.1fus each)"%(single_walk, single_walk / number * 1e6)
+    print "  speedup:             %.2fx"%(by_search / single_walk)
+
+def bench_object_size():
+    record = IndivoRecord(record_id='r1', label='Sebastian Rockwell Cotour')
+    record.fullshares = {}
+    record.carenetshares = []
+    record.owner = None
+    account = IndivoAccount(account_id='scotour@hotmail.com', full_name='Sebastian Cotour')
+    contact = IndivoContact.from_etree(etree.XML(CONTACT_XML))
+    dict_contact = type('DictContact', (object,), {})()
+    dict_contact.__dict__.update(vars_of(contact))
+
+    print "Object size (bytes, excluding attribute values):"
+    for name, slotted, dict_backed in (
+        ('IndivoRecord', record, DictRecord('r1', 'Sebastian Rockwell Cotour')),
+        ('IndivoAccount', account, DictAccount('scotour@hotmail.com', 'Sebastian Cotour')),
+        ('IndivoContact', contact, dict_contact)):
+        print "  %-14s dict: %4d  slots: %4d"%(name, object_size(dict_backed), object_size(slotted))
+
+def vars_of(obj):
+    return dict([(attr, getattr(obj, attr)) for attr in obj.__slots__])
+
+if __name__ == '__main__':
+    bench_contact_parsing()
+    print
+    bench_object_size()
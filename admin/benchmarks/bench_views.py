@@ -0,0 +1,116 @@
+"""
+Benchmark of the admin's main views against a stand-in Indivo server.
+
+Drives admin_record_show, admin_account_show, admin_record_search and admin_record_create
+through the Django test client, and reports the wall time, Indivo API calls per request
+and peak memory of each. The API call counts catch changes in fan-out: a view that
+starts making more calls per request shows up here before it shows up in production.
+
+  DJANGO_SETTINGS_MODULE=settings python -m admin.benchmarks.bench_views --records=5000 --latency=20
+
+By default the admin calls the stand-in in-process. With --http, the stand-in is served
+on a local port and called through the Indivo client, as a live Indivo would be.
+
+"""
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.test.client import Client
+from django.test.simple import DjangoTestSuiteRunner
+from django.test.utils import setup_test_environment, teardown_test_environment
+from admin.benchmarks.standin import StandInIndivo, StandInClient, serve
+from admin.lib.indivo import IndivoModel
+from admin.lib.pool import ClientPool
+from optparse import OptionParser
+import resource
+import time
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def scenarios(app, iterations):
+    """ (view name, [(method, path, data), ...]) for each view benchmarked. """
+    record_ids = sorted(app.records.keys(), key=lambda r: int(r[1:]))
+    account_ids = sorted(app.accounts.keys())
+    pick = lambda ids, i: ids[(i * 7919) % len(ids)]
+    return [
+        ('admin_record_show', [('get', '/admin/record/%s/'%pick(record_ids, i), None)
+                               for i in range(iterations)]),
+        ('admin_account_show', [('get', '/admin/account/%s/'%pick(account_ids, i), None)
+                                for i in range(iterations)]),
+        ('admin_record_search', [('get', '/admin/record/search', {'search_string': name})
+                                 for name in ['Ada', 'Costa', 'Hiro', 'Gallo', 'Ines'] * iterations]
+                                [:iterations]),
+        ('admin_record_create', [('post', '/admin/record/', {
+                        'full_name': 'Benchmark Patient %s'%i, 'email': 'patient%s@example.org'%i,
+                        'street_address': '1 Main St.', 'postal_code': '02115', 'country': 'USA',
+                        'phone_number': '5555550100'})
+                                 for i in range(iterations)]),
+        ]
+
+def run(app, client, iterations):
+    print "%-22s %9s %10s %13s %13s %10s"%('view', 'requests', 'total (s)', 'per req (ms)',
+                                           'calls / req', 'peak MB')
+    for name, requests in scenarios(app, iterations):
+        app.reset_calls()
+        started = time.time()
+        for method, path, data in requests:
+            response = getattr(client, method)(path, data or {})
+            assert response.status_code in (200, 302), \
+                "%s %s returned %s"%(method.upper(), path, response.status_code)
+        elapsed = time.time() - started
+        print "%-22s %9s %10.3f %13.1f %13.1f %10.1f"%(name, len(requests), elapsed,
+                                                      elapsed / len(requests) * 1000,
+                                                      float(app.calls) / len(requests), peak_rss_mb())
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--records', type='int', default=1000, help="Records on the stand-in")
+    parser.add_option('--accounts', type='int', default=200, help="Accounts on the stand-in")
+    parser.add_option('--shares', type='int', default=2, help="Full shares per record")
+    parser.add_option('--carenets', type='int', default=2, help="Carenets per record")
+    parser.add_option('--latency', type='float', default=0,
+                      help="Milliseconds to add to every Indivo API call")
+    parser.add_option('--iterations', type='int', default=20, help="Requests per view")
+    parser.add_option('--http', action='store_true', default=False,
+                      help="Serve the stand-in on a local port and call it over HTTP")
+    parser.add_option('--cache', action='store_true', default=False,
+                      help="Keep the configured INDIVO_API_CACHE (off by default, to count every call)")
+    options, args = parser.parse_args()
+
+    app = StandInIndivo(records=options.records, accounts=options.accounts,
+                        shares_per_record=options.shares, carenets_per_record=options.carenets,
+                        latency=options.latency / 1000.0)
+    manager = IndivoModel.manager
+    if options.http:
+        server = serve(app)
+        settings.INDIVO_SERVER_LOCATION = {'scheme': 'http', 'host': '127.0.0.1',
+                                           'port': str(server.server_port)}
+        manager.pool = ClientPool(manager.get_indivo_client, size=manager.pool.size,
+                                  max_in_use=manager.pool.max_in_use)
+    else:
+        manager.pool = ClientPool(lambda: StandInClient(app), size=manager.pool.size,
+                                  max_in_use=manager.pool.max_in_use)
+    if not options.cache:
+        manager.cache = None
+    settings.INDIVO_READ_FROM_MIRROR = False
+
+    setup_test_environment()
+    runner = DjangoTestSuiteRunner(verbosity=0, interactive=False)
+    old_config = runner.setup_databases()
+    try:
+        User.objects.create_superuser('benchmark', 'benchmark@example.org', 'benchmark')
+        client = Client()
+        client.login(username='benchmark', password='benchmark')
+
+        print "Stand-in Indivo: %s records, %s accounts, %sms latency, %s"%(
+            options.records, options.accounts, options.latency,
+            'over HTTP' if options.http else 'in-process')
+        run(app, client, options.iterations)
+    finally:
+        runner.teardown_databases(old_config)
+        teardown_test_environment()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,359 @@
+"""
+A stand-in Indivo server, for benchmarking the admin without a live Indivo.
+
+StandInIndivo is a WSGI app serving the parts of Indivo's REST API the admin uses,
+over synthetic records, accounts, shares and carenets, with optional latency added
+to every request. Serve it on a local port with serve(), and point the admin's
+INDIVO_SERVER_LOCATION at it, or skip the network with StandInClient, which calls
+the app in-process in place of the Indivo client.
+
+It doesn't check OAuth signatures, and only knows the response formats the admin reads.
+
+"""
+
+from SocketServer import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, make_server
+from wsgiref.util import setup_testing_defaults
+from xml.sax.saxutils import escape, quoteattr
+from cStringIO import StringIO
+from urllib import urlencode, quote
+import cgi
+import re
+import threading
+import time
+
+DOC_NS = 'http://indivo.org/vocab/xml/documents#'
+
+# Indivo client calls, and the requests they make
+CLIENT_CALLS = [
+    ('record_search', 'GET', '/records/search/'),
+    ('account_search', 'GET', '/accounts/search'),
+    ('create_record', 'POST', '/records/'),
+    ('create_account', 'POST', '/accounts/'),
+    ('read_record', 'GET', '/records/{record_id}'),
+    ('read_special_document', 'GET', '/records/{record_id}/documents/special/{special_document}'),
+    ('get_record_owner', 'GET', '/records/{record_id}/owner'),
+    ('set_record_owner', 'PUT', '/records/{record_id}/owner'),
+    ('get_shares', 'GET', '/records/{record_id}/shares/'),
+    ('create_share', 'POST', '/records/{record_id}/shares/'),
+    ('delete_share', 'POST', '/records/{record_id}/shares/{account_id}/delete'),
+    ('get_record_carenets', 'GET', '/records/{record_id}/carenets/'),
+    ('get_carenet_accounts', 'GET', '/carenets/{carenet_id}/accounts/'),
+    ('account_info', 'GET', '/accounts/{account_id}'),
+    ('get_account_records', 'GET', '/accounts/{account_id}/records/'),
+    ('account_set_state', 'POST', '/accounts/{account_id}/set-state'),
+]
+
+PATH_ARG = re.compile(r'\{(\w+)\}')
+
+def _path_pattern(path):
+    return re.compile('^%s$'%PATH_ARG.sub(r'(?P<\1>[^/]+)', path))
+
+GIVEN_NAMES = ['Ada', 'Bram', 'Chloe', 'Dev', 'Elena', 'Femi', 'Greta', 'Hiro', 'Ines', 'Jonas']
+FAMILY_NAMES = ['Archer', 'Baptiste', 'Costa', 'Dubois', 'Eriksen', 'Fujita', 'Gallo', 'Haddad']
+CARENET_NAMES = ['Family', 'Physicians', 'Work/School']
+
+class StandInIndivo(object):
+    """ A WSGI app answering Indivo API requests from synthetic data.
+
+    Record i is owned by an account, fully shared with shares_per_record others, and
+    has carenets_per_record carenets of carenet_size accounts each. Every request
+    sleeps for latency seconds before it's answered, and is counted in calls.
+
+    """
+
+    def __init__(self, records=1000, accounts=200, shares_per_record=2, carenets_per_record=2,
+                 carenet_size=2, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+        self.call_counts = {}
+        self._lock = threading.Lock()
+        self._routes = [(name, method, _path_pattern(path)) for name, method, path in CLIENT_CALLS]
+
+        self.accounts = {}
+        for j in range(accounts):
+            account_id = 'account%s@example.org'%j
+            self.accounts[account_id] = {'full_name': 'Account %s'%j, 'state': 'active'}
+        account_ids = sorted(self.accounts.keys(), key=lambda a: int(a[7:].split('@')[0]))
+
+        self.records = {}
+        self.carenets = {}
+        for i in range(records):
+            record_id = 'r%s'%i
+            pick = lambda n: account_ids[(i + n) % len(account_ids)]
+            self.records[record_id] = {
+                'label': '%s %s %s'%(GIVEN_NAMES[i % len(GIVEN_NAMES)],
+                                     FAMILY_NAMES[i % len(FAMILY_NAMES)], i),
+                'contact': None,
+                'owner': pick(0),
+                'shares': [pick(n) for n in range(1, shares_per_record + 1)],
+                'carenets': [],
+                }
+            for c in range(carenets_per_record):
+                carenet_id = '%s-c%s'%(record_id, c)
+                self.carenets[carenet_id] = [pick(shares_per_record + 1 + c * carenet_size + n)
+                                             for n in range(carenet_size)]
+                self.records[record_id]['carenets'].append(
+                    (carenet_id, CARENET_NAMES[c % len(CARENET_NAMES)]))
+        self._next_record = records
+
+    def reset_calls(self):
+        with self._lock:
+            self.calls = 0
+            self.call_counts = {}
+
+    def __call__(self, environ, start_response):
+        method = environ['REQUEST_METHOD']
+        path = environ.get('PATH_INFO', '')
+        params = dict([(k, v[0]) for k, v in cgi.parse_qs(environ.get('QUERY_STRING', '')).items()])
+        body = ''
+        if method in ('POST', 'PUT'):
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+            body = environ['wsgi.input'].read(length) if length else ''
+            if not body.lstrip().startswith('<'):
+                params.update(dict([(k, v[0]) for k, v in cgi.parse_qs(body).items()]))
+
+        for name, route_method, pattern in self._routes:
+            match = pattern.match(path)
+            if match and route_method == method:
+                with self._lock:
+                    self.calls += 1
+                    self.call_counts[name] = self.call_counts.get(name, 0) + 1
+                if self.latency:
+                    time.sleep(self.latency)
+                status, data = getattr(self, 'do_%s'%name)(params, body, **match.groupdict())
+                break
+        else:
+            status, data = 404, 'Not Found'
+
+        content_type = 'application/xml' if data.startswith('<') else 'text/plain'
+        start_response('%s %s'%(status, 'OK' if status == 200 else 'Error'),
+                       [('Content-Type', content_type), ('Content-Length', str(len(data)))])
+        return [data]
+
+    # responses
+
+    def _account_xml(self, account_id):
+        account = self.accounts[account_id]
+        return ('<Account id=%s><fullName>%s</fullName><contactEmail>%s</contactEmail>'
+                '<state>%s</state><secret>123456</secret></Account>'%(
+                quoteattr(account_id), escape(account['full_name']), escape(account_id),
+                account['state']))
+
+    def _record(self, record_id):
+        record = self.records.get(record_id)
+        if record is None:
+            raise KeyError(record_id)
+        return record
+
+    def do_record_search(self, params, body):
+        label = params.get('label', '').lower()
+        matches = sorted([(r['label'], record_id) for record_id, r in self.records.items()
+                          if label in r['label'].lower()])
+        offset = int(params.get('offset', 0))
+        if 'limit' in params:
+            matches = matches[offset:offset + int(params['limit'])]
+        return 200, '<Records>%s</Records>'%''.join(['<Record id=%s label=%s/>'%(
+                    quoteattr(record_id), quoteattr(label)) for label, record_id in matches])
+
+    def do_account_search(self, params, body):
+        full_name = params.get('fullname', '').lower()
+        contact_email = params.get('contact_email', '').lower()
+        matches = [account_id for account_id, a in sorted(self.accounts.items())
+                   if full_name in a['full_name'].lower() and contact_email in account_id]
+        return 200, '<Accounts>%s</Accounts>'%''.join([self._account_xml(a) for a in matches])
+
+    def do_create_record(self, params, body):
+        with self._lock:
+            record_id = 'r%s'%self._next_record
+            self._next_record += 1
+        match = re.search(r'<fullName>(.*?)</fullName>', body)
+        self.records[record_id] = {'label': match and match.group(1) or record_id,
+                                   'contact': body, 'owner': None, 'shares': [], 'carenets': []}
+        return 200, '<Record id=%s label=%s/>'%(quoteattr(record_id),
+                                               quoteattr(self.records[record_id]['label']))
+
+    def do_create_account(self, params, body):
+        account_id = params.get('account_id')
+        if not account_id or account_id in self.accounts:
+            return 400, 'Account ID already exists'
+        self.accounts[account_id] = {'full_name': params.get('full_name', ''), 'state': 'active'}
+        return 200, self._account_xml(account_id)
+
+    def do_read_record(self, params, body, record_id):
+        try:
+            record = self._record(record_id)
+        except KeyError:
+            return 404, 'Not Found'
+        return 200, '<Record id=%s label=%s/>'%(quoteattr(record_id), quoteattr(record['label']))
+
+    def do_read_special_document(self, params, body, record_id, special_document):
+        try:
+            record = self._record(record_id)
+        except KeyError:
+            return 404, 'Not Found'
+        if record['contact']:
+            return 200, record['contact']
+        given_name, family_name = (record['label'].split(' ') + [''])[:2]
+        return 200, ('<Contact xmlns="%s"><name><fullName>%s</fullName><givenName>%s</givenName>'
+                     '<familyName>%s</familyName></name><email type="personal"><emailAddress>'
+                     '%s@example.org</emailAddress></email><address type="home"><streetAddress>'
+                     '1 Main St.</streetAddress><postalCode>02115</postalCode><locality>Boston'
+                     '</locality><region>MA</region><country>USA</country></address>'
+                     '<phoneNumber type="home">5555550100</phoneNumber></Contact>'%(
+                DOC_NS, escape(record['label']), escape(given_name), escape(family_name), record_id))
+
+    def do_get_record_owner(self, params, body, record_id):
+        try:
+            owner = self._record(record_id)['owner']
+        except KeyError:
+            return 404, 'Not Found'
+        return 200, '<Account id=%s/>'%quoteattr(owner or '')
+
+    def do_set_record_owner(self, params, body, record_id):
+        try:
+            self._record(record_id)['owner'] = params.get('account_id') or body.strip()
+        except KeyError:
+            return 404, 'Not Found'
+        return 200, ''
+
+    def do_get_shares(self, params, body, record_id):
+        try:
+            shares = self._record(record_id)['shares']
+        except KeyError:
+            return 404, 'Not Found'
+        return 200, '<Shares>%s</Shares>'%''.join(['<Share account=%s/>'%quoteattr(a) for a in shares])
+
+    def do_create_share(self, params, body, record_id):
+        account_id = params.get('account_id')
+        if account_id not in self.accounts:
+            return 400, 'No such account'
+        try:
+            shares = self._record(record_id)['shares']
+        except KeyError:
+            return 404, 'Not Found'
+        if account_id not in shares:
+            shares.append(account_id)
+        return 200, ''
+
+    def do_delete_share(self, params, body, record_id, account_id):
+        try:
+            shares = self._record(record_id)['shares']
+        except KeyError:
+            return 404, 'Not Found'
+        if account_id in shares:
+            shares.remove(account_id)
+        return 200, ''
+
+    def do_get_record_carenets(self, params, body, record_id):
+        try:
+            carenets = self._record(record_id)['carenets']
+        except KeyError:
+            return 404, 'Not Found'
+        return 200, '<Carenets>%s</Carenets>'%''.join(['<Carenet id=%s name=%s/>'%(
+                    quoteattr(c_id), quoteattr(name)) for c_id, name in carenets])
+
+    def do_get_carenet_accounts(self, params, body, carenet_id):
+        if carenet_id not in self.carenets:
+            return 404, 'Not Found'
+        return 200, '<CarenetAccounts>%s</CarenetAccounts>'%''.join([
+                '<CarenetAccount id=%s/>'%quoteattr(a) for a in self.carenets[carenet_id]])
+
+    def do_account_info(self, params, body, account_id):
+        if account_id not in self.accounts:
+            return 404, 'Not Found'
+        return 200, self._account_xml(account_id)
+
+    def do_get_account_records(self, params, body, account_id):
+        if account_id not in self.accounts:
+            return 404, 'Not Found'
+        carenet_names = {}
+        for record_id, record in self.records.items():
+            for c_id, name in record['carenets']:
+                if account_id in self.carenets[c_id]:
+                    carenet_names.setdefault(record_id, []).append(name)
+
+        records = []
+        for record_id, record in sorted(self.records.items()):
+            if record['owner'] == account_id:
+                records.append('<Record id=%s label=%s/>'%(quoteattr(record_id),
+                                                            quoteattr(record['label'])))
+            elif account_id in record['shares']:
+                records.append('<Record id=%s label=%s shared="true"/>'%(
+                        quoteattr(record_id), quoteattr(record['label'] + ' (shared)')))
+            for name in carenet_names.get(record_id, []):
+                records.append('<Record id=%s label=%s shared="true" carenet_name=%s/>'%(
+                        quoteattr(record_id), quoteattr(record['label'] + ' (carenet)'),
+                        quoteattr(name)))
+        return 200, '<Records>%s</Records>'%''.join(records)
+
+    def do_account_set_state(self, params, body, account_id):
+        if account_id not in self.accounts:
+            return 404, 'Not Found'
+        self.accounts[account_id]['state'] = params.get('state', 'active')
+        return 200, ''
+
+class StandInClient(object):
+    """ Stands in for the Indivo client, making its calls on a StandInIndivo in-process. """
+
+    def __init__(self, app):
+        self.app = app
+        self._calls = dict([(name, (method, path)) for name, method, path in CLIENT_CALLS])
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name not in self._calls:
+            raise AttributeError(name)
+        method, path = self._calls[name]
+
+        def api_call(*args, **kwargs):
+            data = kwargs.pop('data', args[0] if args else None)
+            parameters = kwargs.pop('parameters', None) or {}
+            path_args = dict([(k, quote(str(v), safe='@')) for k, v in kwargs.items()])
+            return self._request(method, PATH_ARG.sub(lambda m: path_args[m.group(1)], path),
+                                 parameters, data)
+        return api_call
+
+    def _request(self, method, path, parameters, data):
+        if isinstance(data, dict):
+            body = urlencode(dict([(k, v) for k, v in data.items() if v is not None]))
+        elif isinstance(data, unicode):
+            body = data.encode('utf-8')
+        else:
+            body = data or ''
+
+        environ = {
+            'REQUEST_METHOD': method,
+            'PATH_INFO': path,
+            'QUERY_STRING': urlencode(dict([(k, v) for k, v in parameters.items() if v is not None])),
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.input': StringIO(body),
+            }
+        setup_testing_defaults(environ)
+        response = {}
+        def start_response(status, headers):
+            response['response_status'] = int(status.split(' ', 1)[0])
+            response['content_type'] = dict(headers).get('Content-Type')
+        response['response_data'] = ''.join(self.app(environ, start_response))
+        return response
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+def serve(app, host='127.0.0.1', port=0):
+    """ Serve app on a background thread, returning the server (see server.server_port). """
+    server = make_server(host, port, app, server_class=ThreadingWSGIServer,
+                         handler_class=QuietRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, name='standin-indivo')
+    thread.daemon = True
+    thread.start()
+    return server
+
+if __name__ == '__main__':
+    import sys
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8004
+    print "Serving a stand-in Indivo on port %s..."%port
+    make_server('', port, StandInIndivo(), server_class=ThreadingWSGIServer).serve_forever()
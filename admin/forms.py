@@ -1,4 +1,5 @@
 from django import forms
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.auth.forms import UserChangeForm, UserCreationForm
 from django.utils.translation import ugettext_lazy as _
@@ -80,3 +81,36 @@ class AccountForm(forms.Form):
     full_name = forms.CharField()
     email = forms.EmailField()
 
+
+class IdListField(forms.CharField):
+    """ A list of ids, separated by commas, spaces or new lines. """
+
+    widget = forms.Textarea
+
+    def clean(self, value):
+        value = super(IdListField, self).clean(value)
+        ids = []
+        for id in value.replace(',', ' ').split():
+            if id not in ids:
+                ids.append(id)
+        return ids
+
+class BulkShareForm(forms.Form):
+    ACTION_CHOICES = (
+        ('grant', "Grant Full Shares"),
+        ('revoke', "Revoke Full Shares"),
+    )
+    record_ids = IdListField(label=_("Record IDs"))
+    account_ids = IdListField(label=_("Account IDs"))
+    action = forms.ChoiceField(choices=ACTION_CHOICES, initial='grant', widget=forms.RadioSelect)
+
+    def clean(self):
+        # every change is made while the request waits: bigger jobs belong in share_records
+        cleaned_data = self.cleaned_data
+        limit = getattr(settings, 'BULK_SHARE_WEB_LIMIT', 100)
+        shares = len(cleaned_data.get('record_ids', [])) * len(cleaned_data.get('account_ids', []))
+        if shares > limit:
+            raise forms.ValidationError(_("That's %(shares)s shares, but at most %(limit)s can be "
+                                          "changed here at once: use 'manage.py share_records' "
+                                          "for more.")%{'shares': shares, 'limit': limit})
+        return cleaned_data
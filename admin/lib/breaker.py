@@ -0,0 +1,94 @@
+"""
+Circuit breaker for the Indivo API, and the errors raised when Indivo is unavailable.
+
+"""
+
+import threading
+import time
+
+class IndivoUnavailable(Exception):
+    """ Indivo couldn't be reached, or is failing so often that we've stopped trying. """
+    pass
+
+class IndivoTimeout(IndivoUnavailable):
+    """ Indivo didn't answer a call before its deadline. """
+    pass
+
+class CircuitBreaker(object):
+    """ Stop calling a backend that keeps failing, and give it time to recover.
+
+    The breaker starts closed, letting calls through. After failure_threshold failures
+    in a row it opens, and for reset_after seconds calls fail straight away. Then it's
+    half open: a single call is let through as a probe, and closes the breaker again if
+    it succeeds, or reopens it if it fails. A probe that hasn't reported back after
+    another reset_after seconds is given up on, and a new one let through.
+
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_after=30):
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._probe_started = None
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """ Raise IndivoUnavailable if calls shouldn't be made right now. """
+        if not self.failure_threshold:
+            return
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN and time.time() - self.opened_at >= self.reset_after:
+                self.state = self.HALF_OPEN
+                self._probing = False
+            if self.state == self.HALF_OPEN and (not self._probing or
+                                                 time.time() - self._probe_started >= self.reset_after):
+                self._probing = True
+                self._probe_started = time.time()
+                return
+        raise IndivoUnavailable("Indivo is failing: not calling it for another %ss"%self.retry_after())
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probing = False
+
+    def record_not_sent(self):
+        """ A call that was let through never reached the backend: it's neither a success
+        nor a failure, but if it was the probe, let another one through. """
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (self.failure_threshold and
+                                                self.failures >= self.failure_threshold):
+                self.state = self.OPEN
+                self.opened_at = time.time()
+                self._probing = False
+
+    def is_open(self):
+        return self.state != self.CLOSED
+
+    def retry_after(self):
+        """ Seconds until the breaker lets a probe through, or 0 if it's closed. """
+        if self.state == self.CLOSED or self.opened_at is None:
+            return 0
+        return max(int(round(self.opened_at + self.reset_after - time.time())), 0)
+
+    def stats(self):
+        with self._lock:
+            return {'state': self.state,
+                    'failures': self.failures,
+                    'retry_after': self.retry_after(),
+                    }
@@ -0,0 +1,200 @@
+"""
+Helpers for bulk operations against Indivo: streaming input, bounded and rate-limited
+concurrent calls, checkpoints to resume from, and run reports.
+
+"""
+
+from django.utils import simplejson
+import Queue
+import codecs
+import csv
+import os
+import threading
+import time
+
+def read_rows(path, format=None):
+    """ Yield (row_number, row) for each row of a CSV or JSONL file, one at a time.
+
+    Row numbers count from 1, skipping a CSV's header line. The format is taken from
+    the file's extension unless given as 'csv' or 'jsonl'.
+
+    """
+    if format is None:
+        format = 'jsonl' if os.path.splitext(path)[1].lower() in ('.jsonl', '.json') else 'csv'
+
+    if format == 'csv':
+        with open(path, 'rb') as f:
+            for row_number, row in enumerate(csv.DictReader(f), 1):
+                yield row_number, dict([(k.strip(), (v or '').decode('utf-8').strip())
+                                        for k, v in row.iteritems() if k])
+    elif format == 'jsonl':
+        with codecs.open(path, 'r', 'utf-8') as f:
+            row_number = 0
+            for line in f:
+                if not line.strip():
+                    continue
+                row_number += 1
+                yield row_number, simplejson.loads(line)
+    else:
+        raise ValueError("Unknown format '%s': expected 'csv' or 'jsonl'"%format)
+
+class RateLimiter(object):
+    """ Space out calls to wait() to at most rate per second, across threads. """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+def run_bulk(func, items, workers=8, rate=None):
+    """ Call func(item) for each item concurrently, yielding (item, result, error).
+
+    Calls are submitted to the Indivo API layer's background pool (see IndivoManager.submit),
+    at most workers of them at a time, so they share its INDIVO_API_MAX_CONCURRENT limit and
+    see the calling thread's identity map and request stats. Results are yielded as calls
+    finish, which isn't necessarily the order of items. Exceptions raised by func are
+    caught and yielded as the error. items is consumed lazily, so it can be a stream of
+    any length. With a rate, calls start at most rate times a second.
+
+    """
+    from admin.lib.indivo import IndivoModel
+    manager = IndivoModel.manager
+    limiter = RateLimiter(rate) if rate else None
+    results = Queue.Queue()
+
+    def call(item):
+        try:
+            if limiter:
+                limiter.wait()
+            results.put((item, func(item), None))
+        except Exception as e:
+            results.put((item, None, e))
+
+    def next_result():
+        # Queue.get only wakes up for KeyboardInterrupt if given a timeout
+        while True:
+            try:
+                return results.get(True, 1)
+            except Queue.Empty:
+                pass
+
+    pending = 0
+    try:
+        for item in items:
+            while pending >= workers:
+                yield next_result()
+                pending -= 1
+            manager.submit(call, item)
+            pending += 1
+        while pending:
+            yield next_result()
+            pending -= 1
+    finally:
+        # if we're stopped early, let the calls already made finish
+        while pending:
+            next_result()
+            pending -= 1
+
+class Checkpoint(object):
+    """ An append-only record of the progress made on each row of a bulk run.
+
+    Each call to save(row_number, *fields) writes a line, and get(row_number) returns the
+    fields last saved for that row, so a run that fails part way can pick up from there.
+    Without a path, progress is only kept in memory.
+
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.rows = {}
+        self._lock = threading.Lock()
+        self._file = None
+
+        if path:
+            if os.path.exists(path):
+                with codecs.open(path, 'r', 'utf-8') as f:
+                    for line in f:
+                        fields = line.rstrip('\n').split('\t')
+                        if len(fields) > 1 and fields[0].isdigit():
+                            self.rows[int(fields[0])] = tuple(fields[1:])
+            self._file = codecs.open(path, 'a', 'utf-8')
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get(self, row_number):
+        return self.rows.get(row_number)
+
+    def save(self, row_number, *fields):
+        fields = tuple([unicode(field) for field in fields])
+        with self._lock:
+            self.rows[row_number] = fields
+            if self._file:
+                self._file.write(u'\t'.join((unicode(row_number),) + fields) + u'\n')
+                self._file.flush()
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+class BulkReport(object):
+    """ Tally the outcome of a bulk run, and summarize it at the end. """
+
+    def __init__(self, noun='rows'):
+        self.noun = noun
+        self.started = time.time()
+        self.results = []
+        self.errors = []
+        self.skipped = []
+
+    def add(self, key, result=None, error=None):
+        if error is not None:
+            self.errors.append((key, error))
+        else:
+            self.results.append((key, result))
+
+    def skip(self, key, result=None):
+        """ Note an item finished by an earlier run. """
+        self.skipped.append((key, result))
+
+    @property
+    def finished(self):
+        return len(self.results) + len(self.errors)
+
+    def summary(self):
+        elapsed = time.time() - self.started
+        rate = self.finished / elapsed if elapsed else 0
+        return "%s %s in %.1fs (%.1f/s): %s succeeded, %s failed, %s skipped"%(
+            self.finished, self.noun, elapsed, rate, len(self.results), len(self.errors),
+            len(self.skipped))
+
+    def error_lines(self):
+        return [u"%s: %s"%(key, error) for key, error in sorted(self.errors)]
+
+def change_shares(record_ids, account_ids, revoke=False, workers=8, rate=None):
+    """ Grant (or revoke) a full share of every record to every account, concurrently.
+
+    Yields ((record_id, account_id), result, error) for each pair as it finishes.
+
+    """
+    from admin.lib.indivo import IndivoRecord, IndivoAccount
+    records = dict([(record_id, IndivoRecord(record_id=record_id)) for record_id in record_ids])
+    accounts = dict([(account_id, IndivoAccount(account_id=account_id)) for account_id in account_ids])
+
+    def change(pair):
+        record, account = records[pair[0]], accounts[pair[1]]
+        if revoke:
+            return record.remove_fullshare_with(account)
+        return record.create_fullshare_with(account)
+
+    pairs = ((record_id, account_id) for record_id in records for account_id in accounts)
+    return run_bulk(change, pairs, workers=workers, rate=rate)
@@ -0,0 +1,184 @@
+"""
+Response cache for the read-only Indivo API calls made by the Admin interface.
+
+"""
+
+from django.conf import settings
+from django.utils.importlib import import_module
+from collections import OrderedDict
+import hashlib
+import threading
+import time
+import uuid
+
+# Read-only client functions whose responses may be cached, mapped to the
+# tags that a later write invalidates them by
+READ_CALLS = {
+    'account_info': lambda args, kwargs: [('account', kwargs.get('account_id'))],
+    'get_account_records': lambda args, kwargs: [('account', kwargs.get('account_id')),
+                                                 ('account-records',)],
+    'get_shares': lambda args, kwargs: [('record', kwargs.get('record_id'))],
+    'get_record_owner': lambda args, kwargs: [('record', kwargs.get('record_id'))],
+    'get_record_carenets': lambda args, kwargs: [('record', kwargs.get('record_id'))],
+    'read_record': lambda args, kwargs: [('record', kwargs.get('record_id'))],
+    'read_special_document': lambda args, kwargs: [('record', kwargs.get('record_id'))],
+    'get_carenet_accounts': lambda args, kwargs: [('carenet', kwargs.get('carenet_id'))],
+    'record_search': lambda args, kwargs: [('search',)],
+    'account_search': lambda args, kwargs: [('search',)],
+}
+
+def _data(args, kwargs):
+    return kwargs.get('data', args[0] if args else None)
+
+def _data_account_id(args, kwargs):
+    data = _data(args, kwargs)
+    if isinstance(data, dict):
+        return data.get('account_id')
+    return data
+
+# Client functions that change Indivo state, mapped to the tags they invalidate.
+# Changing a record's owner also changes the old owner's record list, which we
+# can't name here: it invalidates every cached account record list instead.
+WRITE_CALLS = {
+    'set_record_owner': lambda args, kwargs: [('record', kwargs.get('record_id')),
+                                              ('account', _data_account_id(args, kwargs)),
+                                              ('account-records',)],
+    'create_share': lambda args, kwargs: [('record', kwargs.get('record_id')),
+                                          ('account', _data_account_id(args, kwargs))],
+    'delete_share': lambda args, kwargs: [('record', kwargs.get('record_id')),
+                                          ('account', kwargs.get('account_id'))],
+    'account_set_state': lambda args, kwargs: [('account', kwargs.get('account_id')),
+                                               ('search',)],
+    'create_record': lambda args, kwargs: [('search',)],
+    'create_account': lambda args, kwargs: [('account', _data_account_id(args, kwargs)),
+                                            ('search',)],
+}
+
+class LocalCacheBackend(object):
+    """ An in-process cache, evicting the least recently used entry beyond max_entries. """
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires < time.time():
+                return None
+            self._entries[key] = entry
+            return value
+
+    def get_many(self, keys):
+        ret = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                ret[key] = value
+        return ret
+
+    def set(self, key, value, timeout=None):
+        expires = time.time() + timeout if timeout else None
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expires)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+class DjangoCacheBackend(object):
+    """ Stores entries in Django's configured cache, which is responsible for eviction. """
+
+    def __init__(self, max_entries=None):
+        from django.core.cache import cache
+        self.cache = cache
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def get_many(self, keys):
+        return self.cache.get_many(keys)
+
+    def set(self, key, value, timeout=None):
+        self.cache.set(key, value, timeout)
+
+BACKENDS = {
+    'local': LocalCacheBackend,
+    'django': DjangoCacheBackend,
+}
+
+class ResponseCache(object):
+    """ Cache raw Indivo responses to read-only calls, keyed on the call and its arguments.
+
+    Every cached response carries the version of each tag (record, account, ...) it was
+    stored under. A write bumps the versions of the tags it affects, so stale responses
+    are never read again and age out of the backend on their own. Versions are random,
+    so an evicted version can't bring an old response back to life.
+
+    """
+
+    key_prefix = 'indivo-api'
+
+    @classmethod
+    def from_settings(cls):
+        """ Build the cache configured by settings.INDIVO_API_CACHE, or None if disabled. """
+        config = getattr(settings, 'INDIVO_API_CACHE', None)
+        if not config:
+            return None
+
+        backend_name = config.get('BACKEND', 'local')
+        backend_cls = BACKENDS.get(backend_name)
+        if backend_cls is None:
+            module_name, cls_name = backend_name.rsplit('.', 1)
+            backend_cls = getattr(import_module(module_name), cls_name)
+        backend = backend_cls(max_entries=config.get('MAX_ENTRIES', 1000))
+        return cls(backend, ttl=config.get('TTL', 60))
+
+    def __init__(self, backend, ttl=60):
+        self.backend = backend
+        self.ttl = ttl
+
+    def is_cacheable(self, client_func_name):
+        return client_func_name in READ_CALLS
+
+    def key_for(self, client_func_name, args, kwargs):
+        """ The cache key for a read call, or None if the call can't be cached.
+
+        Take the key before making the call: a write that lands while the call is in 
+        flight then leaves its response under the old, already-invalid key.
+
+        """
+        if not self.is_cacheable(client_func_name):
+            return None
+        versions = self._tag_versions(READ_CALLS[client_func_name](args, kwargs))
+        call = repr((client_func_name, args, sorted(kwargs.items()), versions))
+        return '%s:call:%s'%(self.key_prefix, hashlib.sha1(call).hexdigest())
+
+    def get(self, key):
+        """ Return the cached (status, data) response stored under key, or None. """
+        return self.backend.get(key)
+
+    def set(self, key, response):
+        self.backend.set(key, response, self.ttl)
+
+    def invalidate(self, client_func_name, args, kwargs):
+        """ Invalidate every cached response affected by a call, if it was a write. """
+        get_tags = WRITE_CALLS.get(client_func_name)
+        if get_tags:
+            for tag in get_tags(args, kwargs):
+                self.backend.set(self._tag_key(tag), uuid.uuid4().hex, None)
+
+    def _tag_key(self, tag):
+        return '%s:tag:%s'%(self.key_prefix, ':'.join(['%s'%t for t in tag]))
+
+    def _tag_versions(self, tags):
+        tag_keys = [self._tag_key(tag) for tag in tags]
+        versions = self.backend.get_many(tag_keys)
+        for tag_key in tag_keys:
+            if tag_key not in versions:
+                versions[tag_key] = uuid.uuid4().hex
+                self.backend.set(tag_key, versions[tag_key], None)
+        return [versions[tag_key] for tag_key in tag_keys]
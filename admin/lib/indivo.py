@@ -5,16 +5,99 @@ Utils for the Admin interface.
 
 from django.conf import settings
 from lxml import etree
-from django.template.loader import get_template
-from django.template import Context
+from django.utils.encoding import force_unicode
 from indivo_client_py.lib.client import IndivoClient
+from admin.lib.cache import ResponseCache, READ_CALLS
+from admin.lib.breaker import CircuitBreaker, IndivoUnavailable, IndivoTimeout
+from admin.lib.pool import ClientPool, ClientPoolTimeout
+from admin.lib.singleflight import SingleFlight
+from admin.lib.stats import call_stats, RequestStats
+from admin.lib.typeahead import record_index
+from admin.lib import mirror
+from admin.models import MirroredShare
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+from functools import partial
+from cStringIO import StringIO
+from httplib import HTTPException
+import threading
+import time
+import copy
+import itertools
+import os
+import random
+import re
+import socket
 
 DOC_NS = 'http://indivo.org/vocab/xml/documents#'
 
+# Nested fan-out deeper than this runs inline in the calling thread
+MAX_POOL_DEPTH = 3
+
+XML_START = re.compile(r'\s*<')
+
+# Characters XML 1.0 doesn't allow in a document, even escaped
+XML_INVALID_CHARS = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+# How Indivo says an account id is taken, in a 400 from create_account
+ACCOUNT_ID_TAKEN_RE = re.compile(r'already (exists|taken|in use)', re.I)
+
+class AccountIdTaken(ValueError):
+    """ Indivo refused to create an account because its id is already in use. """
+    pass
+
+def is_xml(response_data, content_type=None):
+    """ Whether a response body is XML, going by its content type if known. """
+    if content_type:
+        return 'xml' in content_type
+    return bool(response_data) and bool(XML_START.match(response_data))
+
+def iter_elements(response_data, tag):
+    """ Incrementally parse an XML document, yielding its tag elements one at a time.
+
+    Each element is freed (along with anything parsed before it) once the caller 
+    moves on to the next one, so read what you need from it before then.
+
+    """
+    if isinstance(response_data, unicode):
+        response_data = response_data.encode('utf-8')
+    for event, element in etree.iterparse(StringIO(response_data), events=('end',), tag=tag):
+        yield element
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
 class IndivoManager(object):
     def __init__(self):
-        self.client = self.get_indivo_client()
+        pool_settings = getattr(settings, 'INDIVO_CLIENT_POOL', {})
+        self.pool = ClientPool(self.get_indivo_client, 
+                               size=pool_settings.get('SIZE', 8),
+                               max_in_use=pool_settings.get('PER_HOST', None),
+                               timeout=pool_settings.get('TIMEOUT', None))
         self.default_account_id = None
+        self.default_account_checked = 0
+        self.max_workers = getattr(settings, 'INDIVO_API_MAX_WORKERS', 8)
+        self.max_concurrent = getattr(settings, 'INDIVO_API_MAX_CONCURRENT', 32)
+        self._executors = {}
+        self._async_executor = None
+        self._executors_lock = threading.Lock()
+        self._local = threading.local()
+        self.cache = ResponseCache.from_settings()
+
+        self.coalesce = getattr(settings, 'INDIVO_API_COALESCE_READS', True)
+        self.flights = SingleFlight()
+        self._write_generation = 0
+
+        self.timeout = getattr(settings, 'INDIVO_API_TIMEOUT', 10)
+        self.search_paging = getattr(settings, 'INDIVO_SEARCH_PAGING', None)
+        self._call_executor = None
+        retry_settings = getattr(settings, 'INDIVO_API_RETRY', {})
+        self.retry_attempts = max(retry_settings.get('ATTEMPTS', 3), 1)
+        self.retry_backoff = retry_settings.get('BACKOFF', 0.1)
+        self.retry_max_backoff = retry_settings.get('MAX_BACKOFF', 2)
+        breaker_settings = getattr(settings, 'INDIVO_API_CIRCUIT_BREAKER', {})
+        self.breaker = CircuitBreaker(failure_threshold=breaker_settings.get('FAILURES', 5),
+                                      reset_after=breaker_settings.get('RESET_AFTER', 30))
 
     def get_indivo_client(self):
         key, secret = settings.INDIVO_OAUTH_CREDENTIALS
@@ -22,11 +105,210 @@ class IndivoManager(object):
         return client
 
     def make_api_call(self, client_func_name, *args, **kwargs):
-        client_func = getattr(self.client, client_func_name, None)
-        if not client_func:
-            raise ValueError('Invalid API Call: %s'%(client_func_name))
+        """ Make an API call, returning (status, data), with data parsed if it's XML.
+
+        Identical read calls made at the same time, by any threads, share one request
+        and its parsed response: treat the data as read-only.
+
+        """
+        flight_key = self._flight_key('parsed', client_func_name, args, kwargs)
+        if flight_key is None:
+            return self._make_api_call(client_func_name, args, kwargs)
+        return self.flights.do(flight_key, partial(self._make_api_call, client_func_name, args, kwargs))
+
+    def _make_api_call(self, client_func_name, args, kwargs):
+        response_code, response_data, content_type = self._get_response(client_func_name, args, kwargs)
         
-        resp = client_func(*args, **kwargs)
+        # if the response was XML, return an etree
+        if is_xml(response_data, content_type):
+            try:
+                response_data = etree.XML(response_data)
+            except (etree.XMLSyntaxError, ValueError):
+                pass
+
+        return (response_code, response_data)
+
+    def iter_api_call(self, client_func_name, tag, *args, **kwargs):
+        """ Make an API call that returns a list, parsing the tag elements in it one at a time.
+
+        Returns (status, elements), where elements is an iterator over the tag elements 
+        if the call succeeded with an XML response. Otherwise, the response is returned
+        as make_api_call would.
+
+        """
+        response_code, response_data, content_type = self._get_response(client_func_name, args, kwargs)
+        if not is_xml(response_data, content_type):
+            return (response_code, response_data)
+        if response_code != 200:
+            try:
+                return (response_code, etree.XML(response_data))
+            except (etree.XMLSyntaxError, ValueError):
+                return (response_code, response_data)
+        return (response_code, iter_elements(response_data, tag))
+
+    def _get_response(self, client_func_name, args, kwargs):
+        """ Make an API call, or answer it from the cache, sharing identical reads in flight. """
+        flight_key = self._flight_key('raw', client_func_name, args, kwargs)
+        if flight_key is None:
+            return self._fetch_response(client_func_name, args, kwargs)
+        return self.flights.do(flight_key, partial(self._fetch_response, client_func_name, args, kwargs))
+
+    def _flight_key(self, kind, client_func_name, args, kwargs):
+        """ The key identical concurrent calls share, or None if the call can't be shared.
+
+        A write changes the key of every read after it, so reads never share a response
+        that was requested before a write.
+
+        """
+        if not self.coalesce or client_func_name not in READ_CALLS:
+            return None
+        return (kind, self._write_generation, client_func_name, repr(args),
+                repr(sorted(kwargs.items())))
+
+    def _fetch_response(self, client_func_name, args, kwargs):
+        is_write = client_func_name not in READ_CALLS
+        if is_write:
+            self._write_generation += 1
+        try:
+            return self._cached_response(client_func_name, args, kwargs)
+        finally:
+            if is_write:
+                self._write_generation += 1
+
+    def _cached_response(self, client_func_name, args, kwargs):
+        cache_key = self.cache and self.cache.key_for(client_func_name, args, kwargs)
+        response = cache_key and self.cache.get(cache_key)
+        if response:
+            return response
+        cached = False
+        try:
+            response = self._call_client(client_func_name, *args, **kwargs)
+            if cache_key and response[0] == 200:
+                self.cache.set(cache_key, response)
+                cached = True
+        finally:
+            # a write that raised or timed out may still have gone through
+            if self.cache and not cached:
+                self.cache.invalidate(client_func_name, args, kwargs)
+        return response
+
+    def _call_client(self, client_func_name, *args, **kwargs):
+        """ Make an API call on a pooled client, returning the raw (status, data, content type). 
+
+        The content type is None if the client didn't report one.
+
+        Read calls that time out, can't reach Indivo or get a 5xx response are retried,
+        after a random backoff. Writes are never retried, since they may have gone
+        through. While the circuit breaker is open, calls fail straight away with 
+        IndivoUnavailable. The breaker hears once about each call, however many attempts
+        it took: a failure if it raised or got a 5xx response in the end.
+
+        A call that never got a pooled client raises ClientPoolTimeout, without retrying or 
+        telling the breaker: it never reached Indivo, so says nothing about its health.
+
+        """
+        self.breaker.before_call()
+        attempts = self.retry_attempts if client_func_name in READ_CALLS else 1
+        try:
+            for attempt in range(1, attempts + 1):
+                try:
+                    response = self._call_with_deadline(client_func_name, args, kwargs)
+                except ClientPoolTimeout:
+                    raise
+                except (IndivoUnavailable, IOError, HTTPException) as e:
+                    if attempt == attempts:
+                        if isinstance(e, IndivoUnavailable):
+                            raise
+                        raise IndivoUnavailable("Couldn't reach Indivo: %s"%e)
+                else:
+                    if response[0] < 500 or attempt == attempts:
+                        break
+
+                # full jitter: anywhere up to an exponentially growing cap
+                time.sleep(random.uniform(0, min(self.retry_max_backoff, 
+                                                 self.retry_backoff * 2 ** (attempt - 1))))
+        except ClientPoolTimeout:
+            self.breaker.record_not_sent()
+            raise
+        except Exception:
+            # whatever went wrong, tell the breaker, or a half-open probe never ends
+            self.breaker.record_failure()
+            raise
+
+        if response[0] < 500:
+            self.breaker.record_success()
+        else:
+            self.breaker.record_failure()
+        return response
+
+    def _call_with_deadline(self, client_func_name, args, kwargs):
+        """ Make a single attempt at an API call, raising IndivoTimeout if Indivo takes longer
+        than settings.INDIVO_API_TIMEOUT seconds to answer it.
+
+        The client is checked out of the pool first, under the pool's own timeout, and the 
+        deadline only starts once the request is sent.
+
+        """
+        client = self.pool.acquire()
+        if self.timeout:
+            # a backstop for the sockets' own timeout, which only bounds each read: the call
+            # carries on in the background if it overruns, as there's no cancelling it once
+            # it's sent. Every worker that's busy holds a pooled client, so one is normally
+            # free straight away, but if not the call is dropped rather than sent late.
+            dispatch = _Dispatch()
+            result = self._get_call_executor().apply_async(self._send, (dispatch, client, 
+                                                                        client_func_name, args, kwargs))
+            if not dispatch.sent.wait(self.pool.timeout) and dispatch.abandon():
+                self.pool.release(client)
+                raise ClientPoolTimeout("No thread free to call Indivo after %ss"%self.pool.timeout)
+            started = dispatch.sent_at
+        else:
+            started = time.time()
+
+        try:
+            if self.timeout:
+                try:
+                    response = result.get(max(started + self.timeout - time.time(), 0))
+                except TimeoutError:
+                    raise IndivoTimeout("Indivo didn't answer %s within %ss"%(client_func_name, 
+                                                                              self.timeout))
+            else:
+                response = self._request(client, client_func_name, args, kwargs)
+        except socket.timeout as e:
+            call_stats.record_call(client_func_name, (time.time() - started) * 1000, 'error', 0)
+            raise IndivoTimeout("Indivo didn't answer %s in time: %s"%(client_func_name, e))
+        except Exception:
+            call_stats.record_call(client_func_name, (time.time() - started) * 1000, 'error', 0)
+            raise
+
+        response_code, response_data, content_type = response
+        call_stats.record_call(client_func_name, (time.time() - started) * 1000, response_code,
+                               len(response_data) if isinstance(response_data, basestring) else 0)
+        return response
+
+    def _send(self, dispatch, client, client_func_name, args, kwargs):
+        """ Make a dispatched call in a worker thread, unless the caller has given up on it. """
+        if not dispatch.start():
+            return None
+        return self._request(client, client_func_name, args, kwargs)
+
+    def _request(self, client, client_func_name, args, kwargs):
+        """ Make an API call on a checked out client, returning the client to the pool after. 
+
+        A client whose call raised is discarded rather than returned.
+
+        """
+        try:
+            client_func = getattr(client, client_func_name, None)
+            if not client_func:
+                raise ValueError('Invalid API Call: %s'%(client_func_name))
+        
+            resp = client_func(*args, **kwargs)
+        except:
+            self.pool.release(client, discard=True)
+            raise
+        self.pool.release(client)
+
         try:
             resp = resp.response
         except AttributeError:
@@ -41,19 +323,333 @@ class IndivoManager(object):
                 response_data = resp['prd']
             except KeyError:
                 response_data = ''
-        
-        # if the response was XML, return an etree
+
+        return (response_code, response_data, resp.get('content_type', None))
+
+    def run_parallel(self, funcs):
+        """ Run independent callables concurrently, returning their results in order.
+
+        Each callable is run on a bounded thread pool. Once all of them have finished, 
+        the first exception raised (in call order) is re-raised in the calling thread.
+
+        Callables that fan out again are dispatched to a pool one level deeper, so a
+        worker never waits on tasks queued behind it in its own pool.
+
+        """
+        depth = getattr(self._local, 'depth', 0)
+        if len(funcs) < 2 or self.max_workers < 2 or depth >= MAX_POOL_DEPTH:
+            return [func() for func in funcs]
+
+        executor = self._get_executor(depth)
+        context = (IdentityMap.current(), RequestStats.current())
+        pending = [executor.apply_async(self._run_at_depth, (func, depth + 1, context)) 
+                   for func in funcs]
+        for result in pending:
+            result.wait()
+        return [result.get() for result in pending]
+
+    def submit(self, func, *args, **kwargs):
+        """ Start func(*args, **kwargs) in the background, returning an IndivoFuture for it.
+
+        At most settings.INDIVO_API_MAX_CONCURRENT submitted calls run at once, and the
+        rest queue up behind them, so one thread can start hundreds of calls and collect 
+        their results later. Submitted calls see the caller's identity map.
+
+        Calls submitted from a submitted call run straight away instead, so they can't
+        wait on a queue they're blocking.
+
+        """
+        call = partial(func, *args, **kwargs)
+        if getattr(self._local, 'in_async', False):
+            return IndivoFuture.from_call(call)
+
+        context = (IdentityMap.current(), RequestStats.current())
+        return IndivoFuture(self._get_async_executor().apply_async(self._run_at_depth, 
+                                                                   (call, 1, context)))
+
+    def make_api_call_async(self, client_func_name, *args, **kwargs):
+        """ Like make_api_call, but returning an IndivoFuture for its (status, data). """
+        return self.submit(self.make_api_call, client_func_name, *args, **kwargs)
+
+    def _run_at_depth(self, func, depth, context):
+        """ Run func in a worker thread, in the context (identity map and request stats) 
+        of the thread that dispatched it. """
+        identity_map, request_stats = context
+        self._local.depth = depth
+        IdentityMap.activate(identity_map)
+        if request_stats is not None:
+            RequestStats.activate(request_stats)
         try:
-            response_data = etree.XML(response_data)
-        except Exception, e:
-            pass
+            return func()
+        finally:
+            IdentityMap.deactivate()
+            RequestStats.deactivate()
 
-        return (response_code, response_data)
+    def _get_executor(self, depth):
+        executor = self._executors.get(depth)
+        if executor is None:
+            with self._executors_lock:
+                executor = self._executors.get(depth)
+                if executor is None:
+                    executor = self._executors[depth] = ThreadPool(self.max_workers)
+        return executor
+
+    def _get_async_executor(self):
+        if self._async_executor is None:
+            with self._executors_lock:
+                if self._async_executor is None:
+                    self._async_executor = ThreadPool(self.max_concurrent, 
+                                                      initializer=self._init_async_worker)
+        return self._async_executor
+
+    def _get_call_executor(self):
+        if self._call_executor is None:
+            with self._executors_lock:
+                if self._call_executor is None:
+                    # every call holds a pooled client until it's done, deadline or not, 
+                    # so there are never more of them than this
+                    self._call_executor = ThreadPool(self.pool.max_in_use)
+        return self._call_executor
+
+    def _init_async_worker(self):
+        self._local.in_async = True
+
+class _Dispatch(object):
+    """ A call handed to a worker thread, which the caller can give up on until it's sent. """
+
+    def __init__(self):
+        self.sent = threading.Event()
+        self.sent_at = None
+        self.abandoned = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        """ Mark the call as sent, returning False if the caller gave up on it first. """
+        with self._lock:
+            if self.abandoned:
+                return False
+            self.sent_at = time.time()
+        self.sent.set()
+        return True
+
+    def abandon(self):
+        """ Give up on the call, returning False if it's too late: it was sent already. """
+        with self._lock:
+            if self.sent_at is None:
+                self.abandoned = True
+            return self.abandoned
+
+class IndivoFuture(object):
+    """ The eventual result of a call started with IndivoManager.submit. """
+
+    def __init__(self, async_result):
+        self._result = async_result
+
+    @classmethod
+    def from_call(cls, func):
+        """ A future for a call made right away, in the calling thread. """
+        result = _FinishedResult()
+        try:
+            result.value = func()
+        except Exception as e:
+            result.error = e
+        return cls(result)
+
+    def done(self):
+        return self._result.ready()
+
+    def wait(self, timeout=None):
+        self._result.wait(timeout)
+        return self.done()
+
+    def result(self, timeout=None):
+        """ Wait for the call to finish, returning its result or raising its exception.
+
+        Raises multiprocessing.TimeoutError if it's still running after timeout seconds.
+
+        """
+        return self._result.get(timeout)
+
+    def exception(self, timeout=None):
+        """ Wait for the call to finish, returning the exception it raised, if any. """
+        try:
+            self.result(timeout)
+        except TimeoutError:
+            raise
+        except Exception as e:
+            return e
+        return None
+
+    @staticmethod
+    def gather(futures):
+        """ Wait for all of the futures, returning their results in order.
+
+        As with IndivoManager.run_parallel, the first exception (in order) is re-raised 
+        once all of them have finished.
+
+        """
+        for future in futures:
+            future.wait()
+        return [future.result() for future in futures]
+
+class _FinishedResult(object):
+    """ Stands in for an AsyncResult that was computed straight away. """
+
+    value = None
+    error = None
+
+    def ready(self):
+        return True
+
+    def wait(self, timeout=None):
+        pass
+
+    def get(self, timeout=None):
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+class LazyManager(object):
+    """ Give access to an IndivoManager, built on first use in each process.
+
+    Importing this module, or running management commands that never call Indivo,
+    doesn't build a manager. A process forked after the manager was built gets its own, 
+    so workers never share pooled clients or threads with their parent.
+
+    """
+
+    def __init__(self):
+        self._manager = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def __get__(self, obj, objtype=None):
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    self._manager = IndivoManager()
+                    self._pid = pid
+        return self._manager
+
+class IdentityMap(object):
+    """ Holds at most one IndivoModel object per primary key.
+
+    A map is activated per thread for the duration of a request (see 
+    admin.middleware.IndivoIdentityMapMiddleware), and handed on to the worker threads 
+    that IndivoManager.run_parallel fans out to. Objects are built under a per-key lock, 
+    so concurrent lookups of the same key fetch it only once.
+
+    """
+
+    _local = threading.local()
+
+    @classmethod
+    def current(cls):
+        return getattr(cls._local, 'identity_map', None)
+
+    @classmethod
+    def activate(cls, identity_map=None):
+        if identity_map is None:
+            identity_map = cls()
+        cls._local.identity_map = identity_map
+        return identity_map
+
+    @classmethod
+    def deactivate(cls):
+        cls._local.identity_map = None
+
+    def __init__(self):
+        self._objects = {}
+        self._key_locks = {}
+        self._lock = threading.Lock()
+
+    def get_or_create(self, key, factory):
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            obj = self._objects.get(key)
+            if obj is None:
+                obj = self._objects[key] = factory()
+        return obj
+
+    def clear(self):
+        with self._lock:
+            self._objects.clear()
+            self._key_locks.clear()
+
+NOT_FETCHED = object()
+
+class LazyField(object):
+    """ An attribute of an IndivoModel that is fetched from Indivo on first access.
+
+    The value is loaded by calling the named loader method on the model, and is only
+    fetched if the model has a primary key. Until then, the field returns a fresh
+    copy of its default. Assigning to the field stores the value without a fetch.
+
+    """
+
+    def __init__(self, name, loader, default=None):
+        self.name = name
+        self.attr = '_%s'%name
+        self.loader = loader
+        self.default = default
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+
+        value = getattr(obj, self.attr, NOT_FETCHED)
+        if value is NOT_FETCHED:
+            if obj.pk:
+                value = getattr(obj, self.loader)()
+
+                # loaders may set the field themselves
+                if obj.is_fetched(self.name):
+                    return getattr(obj, self.attr)
+            else:
+                value = self.default() if callable(self.default) else self.default
+            setattr(obj, self.attr, value)
+        return value
+
+    def __set__(self, obj, value):
+        setattr(obj, self.attr, value)
 
 class IndivoModel(object):
-    manager = IndivoManager()
+    __slots__ = ()
+    manager = LazyManager()
     primary_key = None
 
+    @classmethod
+    def get(cls, pk, **kwargs):
+        """ Fetch the object with the given primary key.
+
+        Within a request, each object is built and fetched only once: later lookups of 
+        the same primary key return the same object.
+
+        """
+        identity_map = IdentityMap.current()
+        if identity_map is None:
+            return cls._load(pk, **kwargs)
+        return identity_map.get_or_create((cls, pk), partial(cls._load, pk, **kwargs))
+
+    @classmethod
+    def get_async(cls, pk, **kwargs):
+        """ Like get, but fetching in the background and returning an IndivoFuture. """
+        return cls.manager.submit(cls.get, pk, **kwargs)
+
+    @classmethod
+    def _load(cls, pk, **kwargs):
+        raise NotImplementedError()
+
+    @property
+    def pk(self):
+        return getattr(self, self.primary_key, None)
+
+    def is_fetched(self, field_name):
+        """ Whether a LazyField has been loaded (or set) on this object. """
+        return getattr(self, '_%s'%field_name, NOT_FETCHED) is not NOT_FETCHED
+
     def __eq__(self, other):
         my_pk_field = getattr(self, 'primary_key', None)
         other_pk_field = getattr(other, 'primary_key', None)
@@ -75,8 +671,15 @@ class IndivoModel(object):
 class IndivoRecord(IndivoModel):
     """ Represent an Indivo Record. """
     
+    __slots__ = ('record_id', '_label', '_contact', '_owner', '_fullshares', '_carenetshares')
     primary_key = 'record_id'
 
+    label = LazyField('label', '_load_label')
+    contact = LazyField('contact', '_get_contact')
+    owner = LazyField('owner', '_get_owner')
+    fullshares = LazyField('fullshares', '_get_fullshares', default=dict)
+    carenetshares = LazyField('carenetshares', '_get_carenetshares', default=list)
+
     @classmethod
     def from_etree(cls, xml_etree):
         record = cls()
@@ -84,33 +687,96 @@ class IndivoRecord(IndivoModel):
         record.label = xml_etree.get('label')
         return record
 
+    @classmethod
+    def _load(cls, record_id):
+        return cls(record_id=record_id)
+
     @classmethod
     def from_contact(cls, contact_obj):
         return cls(contact_obj=contact_obj, label=contact_obj.full_name)
 
     @classmethod
-    def search(cls, search_string):
-        matches = []
-        status, data = cls.manager.make_api_call('record_search', parameters={'label':search_string})
-        if status == 200:
-            for record in data.findall('Record'):
-                matches.append(cls.from_etree(record))
-        else:
+    def search(cls, search_string, offset=0, limit=None, from_mirror=None):
+        """ Records whose label matches search_string: at most limit of them, from offset. """
+        return list(cls.iter_search(search_string, offset=offset, limit=limit, from_mirror=from_mirror))
+
+    @classmethod
+    def iter_search(cls, search_string, offset=0, limit=None, from_mirror=None):
+        """ Like search, but yield records one at a time as the response is parsed.
+
+        The search is made right away, but its results are parsed as they're consumed. 
+        A later page is only asked for by its offset and limit if Indivo honours them 
+        (see _search_paging): otherwise Indivo is asked for everything up to the end of 
+        the page, which is windowed here, as asking a server that ignores the paging 
+        parameters for a later page would send back the first.
+
+        The local mirror is searched instead if from_mirror is set, or if it's left as
+        None and settings.INDIVO_READ_FROM_MIRROR is set.
+
+        """
+        if from_mirror or (from_mirror is None and mirror.read_from_mirror()):
+            return (cls(record_id=record_id, label=label) for record_id, label 
+                    in mirror.search_records(search_string, offset=offset, limit=limit))
+
+        if limit is None:
+            return itertools.islice(cls._iter_indivo_search(search_string), offset, None)
+        if offset and cls._search_paging(search_string):
+            return itertools.islice(cls._iter_indivo_search(search_string, offset=offset, limit=limit),
+                                    limit)
+        return itertools.islice(cls._iter_indivo_search(search_string, offset=0, limit=offset + limit),
+                                offset, offset + limit)
+
+    @classmethod
+    def _search_paging(cls, search_string):
+        """ Whether Indivo honours the offset and limit of record searches.
+
+        Unless settings.INDIVO_SEARCH_PAGING says, the first search for a later page
+        finds out by asking for a single match, and the manager remembers the answer: a 
+        search with a later page has more than one match, which a server that ignores 
+        the limit sends back. If the search comes back empty, we're none the wiser.
+
+        """
+        paging = cls.manager.search_paging
+        if paging is None:
+            matches = len(cls.search_page(search_string, 0, 1))
+            if matches:
+                paging = cls.manager.search_paging = (matches == 1)
+        return paging
+
+    @classmethod
+    def search_page(cls, search_string, offset, limit):
+        """ The records Indivo sends back for one page of a search, passing the paging on as is.
+
+        An Indivo that ignores the paging parameters sends every match back instead: callers
+        must cope with more than limit records, or with the first page again.
+
+        """
+        return list(cls._iter_indivo_search(search_string, offset=offset, limit=limit))
+
+    @classmethod
+    def _iter_indivo_search(cls, search_string, **paging):
+        parameters = {'label':search_string}
+        parameters.update(paging)
+        status, data = cls.manager.iter_api_call('record_search', 'Record', parameters=parameters)
+        if status != 200:
             # TODO
             raise ValueError("Bad response from Indivo: [%s] %s"%(status, data))
 
-        return matches
+        # feed the typeahead index as results go by
+        return (cls._indexed(cls.from_etree(record)) for record in data)
+
+    @staticmethod
+    def _indexed(record):
+        record_index.add(record.record_id, record.label)
+        return record
 
     def __init__(self, record_id=None, label=None, contact_obj=None):
+        """ Relationships (contact, owner, shares) are fetched lazily on first access. """
         self.record_id = record_id
-        self.label = label
-        self.contact = contact_obj
-        self.owner = None
-        self.fullshares = {}
-        self.carenetshares = []
-
-        if self.record_id:
-            self._fetch()
+        if label is not None:
+            self.label = label
+        if contact_obj is not None:
+            self.contact = contact_obj
 
     def push(self):
         if self.record_id:
@@ -120,12 +786,14 @@ class IndivoRecord(IndivoModel):
             raise ValueError("No contact data to create record with")
         else:
             self.record_id = self._create_on_server()
+            mirror.save_created_record(self)
 
     def set_owner(self, account):
         status, data = self.manager.make_api_call('set_record_owner', 
                                                   record_id=self.record_id, 
                                                   data=account.account_id)
         if status == 200:
+            mirror.save_share(self.record_id, account, MirroredShare.OWNER)
             return True
         else:
             # TODO
@@ -137,7 +805,9 @@ class IndivoRecord(IndivoModel):
                                                   record_id=self.record_id, 
                                                   data=data)
         if status == 200:
-            self.fullshares[account.account_id] = account
+            if self.is_fetched('fullshares'):
+                self.fullshares[account.account_id] = account
+            mirror.save_share(self.record_id, account, MirroredShare.FULL)
             return True
         else:
             # TODO
@@ -148,20 +818,34 @@ class IndivoRecord(IndivoModel):
                                                   record_id=self.record_id, 
                                                   account_id=account.account_id)
         if status == 200:
-            if self.fullshares.has_key(account.account_id):
+            if self.is_fetched('fullshares') and self.fullshares.has_key(account.account_id):
                 del self.fullshares[account.account_id]
+            mirror.delete_share(self.record_id, account.account_id, MirroredShare.FULL)
             return True
         else:
             # TODO
             raise ValueError("Bad response from Indivo: [%s] %s"%(status, data))
 
-    def _fetch(self):
+    def prefetch(self):
+        """ Load all of the record's relationships, fetching them concurrently. """
         if self.record_id:
-            self.contact = self._get_contact()
-            self.label = self.contact.full_name or self._get_label()
-            self.owner = self._get_owner()
-            self.fullshares = self._get_fullshares()
-            self.carenetshares = self._get_carenetshares()
+            self.contact, self.owner, self.fullshares, carenet_members = \
+                self.manager.run_parallel([self._get_contact, self._get_owner,
+                                           self._get_fullshares, self._get_carenet_members])
+            self.carenetshares = self._build_carenetshares(carenet_members)
+            self.label = self._load_label()
+
+    def prefetch_async(self):
+        """ Like prefetch, but in the background: returns an IndivoFuture for the record. """
+        def prefetch():
+            self.prefetch()
+            return self
+        return self.manager.submit(prefetch)
+
+    def _load_label(self):
+        label = self.contact.full_name or self._get_label()
+        record_index.add(self.record_id, label)
+        return label
 
     def _get_label(self):
         status, data = self.manager.make_api_call('read_record',
@@ -176,17 +860,24 @@ class IndivoRecord(IndivoModel):
         status, data = self.manager.make_api_call('get_shares',
                                                   record_id=self.record_id)
         if status == 200:
-            shares = {}
-            for share in data.findall('Share'):
-                account_id = share.get('account', None)
-                if account_id:
-                    shares[account_id] = IndivoAccount(account_id=account_id, new=False)
-            return shares
+            account_ids = [share.get('account') for share in data.findall('Share') 
+                           if share.get('account', None)]
+            accounts = self.manager.run_parallel([partial(IndivoAccount.get, account_id, summary=True)
+                                                  for account_id in account_ids])
+            return dict(zip(account_ids, accounts))
         else:
             #TODO
             raise ValueError("Bad response from Indivo: [%s] %s"%(status, data))
 
     def _get_carenetshares(self):
+        return self._build_carenetshares(self._get_carenet_members())
+
+    def _get_carenet_members(self):
+        """ Map the ids of accounts in the record's carenets to their carenet names.
+
+        The members of all carenets are fetched concurrently.
+
+        """
         status, data = self.manager.make_api_call('get_record_carenets', 
                                                   record_id=self.record_id)
         if status == 200:
@@ -195,10 +886,12 @@ class IndivoRecord(IndivoModel):
             # TODO
             raise ValueError("Bad response from Indivo: [%s] %s"%(status, data))
 
+        carenet_ids = carenet_names.keys()
+        responses = self.manager.run_parallel([partial(self.manager.make_api_call, 
+                                                       'get_carenet_accounts', carenet_id=c_id)
+                                               for c_id in carenet_ids])
         carenet_accounts = {}
-        for c_id in carenet_names.keys():
-            status, data = self.manager.make_api_call('get_carenet_accounts',
-                                                      carenet_id=c_id)
+        for c_id, (status, data) in zip(carenet_ids, responses):
             if status == 200:
                 for account in data.findall('CarenetAccount'):
                     account_carenets = carenet_accounts.setdefault(account.get('id'), [])
@@ -206,10 +899,25 @@ class IndivoRecord(IndivoModel):
             else:
                 # TODO
                 raise ValueError("Bad response from Indivo: [%s] %s"%(status, data))
+        return carenet_accounts
+
+    def _build_carenetshares(self, carenet_accounts):
+        """ Build labelled accounts for carenet members, reusing the record's loaded accounts. """
+        known_accounts = {}
+        if self.is_fetched('owner') and self.owner:
+            known_accounts[self.owner.account_id] = self.owner
+        if self.is_fetched('fullshares'):
+            known_accounts.update(self.fullshares)
+
+        missing_ids = [a_id for a_id in carenet_accounts.keys() if a_id not in known_accounts]
+        missing_accounts = self.manager.run_parallel([partial(IndivoAccount.get, a_id, summary=True)
+                                                      for a_id in missing_ids])
+        known_accounts.update(zip(missing_ids, missing_accounts))
 
         ret = []
         for email, carenets in carenet_accounts.items():
-            account_obj = IndivoAccount(account_id=email, new=False)
+            # copy, so the label doesn't leak into the owner or share listings
+            account_obj = copy.copy(known_accounts[email])
             account_obj.full_name += (" (%s)"%", ".join(carenets))
             ret.append(account_obj)
         return ret
@@ -219,7 +927,7 @@ class IndivoRecord(IndivoModel):
                                                   record_id=self.record_id)
         if status == 200:
             account_id = data.get('id')
-            return IndivoAccount(account_id=account_id, new=False)
+            return IndivoAccount.get(account_id, summary=True)
         else:
             # TODO
             raise ValueError("Bad response from Indivo: [%s] %s"%(status, data))
@@ -250,47 +958,85 @@ class IndivoRecord(IndivoModel):
 class IndivoAccount(IndivoModel):
     """ Represent and Indivo Account. """
 
+    __slots__ = ('account_id', 'full_name', 'contact_email', 'state', 'secondary_secret', 
+                 'fullshares', '_owned_records', '_fullshared_records', '_carenet_records')
     primary_key = 'account_id'
 
+    owned_records = LazyField('owned_records', '_get_fullshares', default=list)
+    fullshared_records = LazyField('fullshared_records', '_get_fullshares', default=list)
+    carenet_records = LazyField('carenet_records', '_get_fullshares', default=set)
+
     @classmethod
     def from_etree(cls, xml_etree, new=False):
         account = cls(new=new)
         account._update_from_etree(xml_etree)
         return account
 
+    @classmethod
+    def _load(cls, account_id, summary=False):
+        return cls(account_id=account_id, new=False, summary=summary)
+
     @classmethod
     def DEFAULT(cls):
+        """ The account that owns records created in the admin, creating it if need be.
+
+        The account's id is cached per process, and only checked against Indivo again 
+        every settings.DEFAULT_ADMIN_OWNER_REVALIDATE seconds: in between, nothing is fetched.
 
-        # try fetching the account
+        """
+        manager = cls.manager
+        max_age = getattr(settings, 'DEFAULT_ADMIN_OWNER_REVALIDATE', 300)
+        if manager.default_account_id and time.time() - manager.default_account_checked < max_age:
+            return cls(account_id=manager.default_account_id)
+
+        # try fetching the account: its info is enough, not its (ever-growing) record list
         default_info = settings.DEFAULT_ADMIN_OWNER
         try:
-            account = cls(account_id=default_info['email'], 
-                          full_name=default_info['full_name'],
-                          contact_email=default_info['contact_email'], new=False)
+            account = cls.get(default_info['email'], summary=True)
         except ValueError as e:
             account = cls(account_id=default_info['email'], 
                           full_name=default_info['full_name'],
                           contact_email=default_info['contact_email'], new=True)
             
             # account didn't exist: create it
-            account.push()
+            try:
+                account.push()
+            except AccountIdTaken:
+                # another thread or process got there first
+                pass
 
+        manager.default_account_id = account.account_id
+        manager.default_account_checked = time.time()
         return account
 
     @classmethod
     def search(cls, full_name=None, contact_email=None):
         if not full_name and not contact_email:
             return []
+        elif mirror.read_from_mirror():
+            accounts = []
+            for mirrored in mirror.search_accounts(full_name=full_name, contact_email=contact_email):
+                account = cls(account_id=mirrored.account_id, full_name=mirrored.full_name,
+                              contact_email=mirrored.contact_email)
+                account.state = mirrored.state
+                accounts.append(account)
+            return accounts
         else:
             req_data = {'fullname':full_name, 'contact_email':contact_email}
-            status, data = cls.manager.make_api_call('account_search', parameters=req_data)
+            status, data = cls.manager.iter_api_call('account_search', 'Account', parameters=req_data)
             if status == 200:
-                return [cls.from_etree(a) for a in data.findall('Account')]
+                return [cls.from_etree(a) for a in data]
             else:
                 # TODO
                 raise ValueError("Bad response from Indivo: [%s] %s"%(status, data))
 
-    def __init__(self, account_id=None, full_name=None, contact_email=None, new=True):
+    def __init__(self, account_id=None, full_name=None, contact_email=None, new=True, summary=False):
+        """ Fetch an existing account unless new is set.
+
+        With summary set, only the account info is fetched: the record lists are loaded
+        on first access.
+
+        """
         self.account_id = account_id
         self.full_name = full_name
         self.contact_email = contact_email
@@ -299,7 +1045,7 @@ class IndivoAccount(IndivoModel):
         self.fullshares = {}
 
         if not new:
-            self._fetch()
+            self._fetch(summary=summary)
 
     @property
     def secondary_secret_pretty(self):
@@ -309,8 +1055,9 @@ class IndivoAccount(IndivoModel):
 
     def push(self):
         acct_etree = self._create_on_server()
-        if acct_etree:
+        if acct_etree is not None:
             self._update_from_etree(acct_etree)
+            mirror.save_account(self)
 
     def retire(self):
         data = {'state':'retired'}
@@ -319,25 +1066,28 @@ class IndivoAccount(IndivoModel):
                                                   data=data)
         if status == 200:
             self.state = 'retired'
+            mirror.save_account(self)
             return True
         else:
             # TODO
             raise ValueError("Bad response from Indivo: [%s] %s"%(status, data))
 
-    def _fetch(self):
+    def _fetch(self, summary=False):
         if self.account_id:
-            self._get_account_info()
-            self._get_fullshares()
+            if summary:
+                self._get_account_info()
+            else:
+                self.manager.run_parallel([self._get_account_info, self._get_fullshares])
 
     def _get_fullshares(self):
-        status, data = self.manager.make_api_call('get_account_records',
+        status, data = self.manager.iter_api_call('get_account_records', 'Record',
                                                   account_id=self.account_id)
         if status == 200:
             carenetmap = {}
             carenetshared = set([])
             fullshared = []
             owned = []
-            for record in data.findall('Record'):
+            for record in data:
                 record_obj = IndivoRecord.from_etree(record)
                 shared = record.get('shared', None)
                 if not shared:
@@ -391,15 +1141,26 @@ class IndivoAccount(IndivoModel):
         if status == 200:
             return data
 
-        # account_id already taken
-        elif status == 400:
-            # TODO
-            raise ValueError(data)
+        # Indivo refuses other bad requests with a 400 too
+        elif status == 400 and ACCOUNT_ID_TAKEN_RE.search(force_unicode(data, errors='replace')):
+            raise AccountIdTaken(data)
 
         else:
             # TODO
             raise ValueError("Bad response from Indivo: [%s] %s"%(status, data))
 
+# Contact document elements, mapped to the IndivoContact attributes they fill
+CONTACT_TEXT_FIELDS = {
+    'fullName': 'full_name',
+    'givenName': 'given_name',
+    'familyName': 'family_name',
+    'emailAddress': 'email',
+    'streetAddress': 'street_address',
+    'region': 'region',
+    'postalCode': 'postal_code',
+    'country': 'country',
+}
+
 class IndivoContact(object):
     """ Represent an Indivo Contact Document.
 
@@ -436,7 +1197,16 @@ class IndivoContact(object):
 
     """
     
+    __slots__ = ('full_name', 'given_name', 'family_name', 'email', 'street_address',
+                 'region', 'postal_code', 'country', 'phone_numbers')
     ns = DOC_NS
+
+    text_fields = dict([('{%s}%s'%(DOC_NS, tag), attr) for tag, attr in CONTACT_TEXT_FIELDS.items()])
+
+    # Every element from_etree reads, found in a single walk of the document
+    fields_xpath = etree.XPath('|'.join(['.//doc:%s'%tag for tag in CONTACT_TEXT_FIELDS] 
+                                        + ['doc:phoneNumber']),
+                               namespaces={'doc': DOC_NS})
     
     def __init__(self, data={}):
         self.full_name = None
@@ -456,7 +1226,40 @@ class IndivoContact(object):
                 pass
     
     def to_xml(self):
-        return get_template("contact.xml").render(Context({'contact':self}))
+        """ Serialize to a Contact document.
+
+        The document is built directly with lxml. Characters XML can't hold (control
+        characters, pasted in with the contact's details) are left out.
+
+        """
+        return self._build_xml()
+
+    def _build_xml(self):
+        def add(parent, tag, **attrs):
+            return etree.SubElement(parent, '{%s}%s'%(self.ns, tag), **attrs)
+
+        # render text as the template does, so unset values come out as 'None'
+        def add_text(parent, tag, value, **attrs):
+            el = add(parent, tag, **attrs)
+            el.text = XML_INVALID_CHARS.sub(u'', force_unicode(value))
+            return el
+
+        contact = etree.Element('{%s}Contact'%self.ns, nsmap={None: self.ns})
+        name = add(contact, 'name')
+        add_text(name, 'fullName', self.full_name)
+        add_text(name, 'givenName', self.given_name)
+        add_text(name, 'familyName', self.family_name)
+        email = add(contact, 'email', type='personal')
+        add_text(email, 'emailAddress', self.email)
+        address = add(contact, 'address', type='home')
+        add_text(address, 'streetAddress', self.street_address)
+        add_text(address, 'postalCode', self.postal_code)
+        add_text(address, 'locality', '')
+        add_text(address, 'region', self.region)
+        add_text(address, 'country', self.country)
+        for phone_number in self.phone_numbers:
+            add_text(contact, 'phoneNumber', phone_number, type='home')
+        return etree.tostring(contact, encoding=unicode)
 
     @classmethod
     def find_text_anywhere(cls, xml_etree, tagname):
@@ -475,13 +1278,12 @@ class IndivoContact(object):
     @classmethod
     def from_etree(cls, xml_etree):
         contact = cls()
-        contact.full_name = cls.find_text_anywhere(xml_etree, 'fullName')
-        contact.given_name = cls.find_text_anywhere(xml_etree, 'givenName')
-        contact.family_name = cls.find_text_anywhere(xml_etree, 'familyName')
-        contact.email = cls.find_text_anywhere(xml_etree, 'emailAddress')
-        contact.street_address  = cls.find_text_anywhere(xml_etree, 'streetAddress')
-        contact.region = cls.find_text_anywhere(xml_etree, 'region')
-        contact.postal_code = cls.find_text_anywhere(xml_etree, 'postalCode')
-        contact.country = cls.find_text_anywhere(xml_etree, 'country')
-        contact.phone_numbers = cls.findalltext(xml_etree, '{%s}phoneNumber'%cls.ns)
+        for el in cls.fields_xpath(xml_etree):
+            attr = cls.text_fields.get(el.tag)
+            if attr is None:
+                contact.phone_numbers.append(el.text)
+
+            # like findtext, the first match wins and empty elements give ''
+            elif getattr(contact, attr) is None:
+                setattr(contact, attr, el.text or '')
         return contact
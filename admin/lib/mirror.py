@@ -0,0 +1,169 @@
+"""
+The local mirror of Indivo records, accounts and shares.
+
+"""
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from admin.models import MirroredRecord, MirroredAccount, MirroredShare
+from functools import partial
+import datetime
+
+def read_from_mirror():
+    """ Whether searches should be answered from the mirror instead of Indivo. """
+    return getattr(settings, 'INDIVO_READ_FROM_MIRROR', False)
+
+def fetch_record_graph(record):
+    """ Fetch what the mirror holds about a record from Indivo.
+
+    Returns (record, accounts, shares), where shares are (account_id, kind, carenet_name)
+    and accounts are the summary IndivoAccounts they refer to. Safe to call from worker
+    threads: it doesn't touch the database.
+
+    """
+    from admin.lib.indivo import IndivoAccount
+    record.contact, record.owner, record.fullshares, carenet_members = \
+        record.manager.run_parallel([record._get_contact, record._get_owner,
+                                     record._get_fullshares, record._get_carenet_members])
+    record.label = record.contact.full_name or record.label or record._get_label()
+
+    accounts = {}
+    shares = []
+    if record.owner and record.owner.account_id:
+        accounts[record.owner.account_id] = record.owner
+        shares.append((record.owner.account_id, MirroredShare.OWNER, ''))
+    for account_id, account in record.fullshares.items():
+        accounts[account_id] = account
+        shares.append((account_id, MirroredShare.FULL, ''))
+
+    # carenet members are fetched as plain accounts: the record's carenetshares carry
+    # the carenet names in their full_name
+    missing_ids = [a_id for a_id in carenet_members.keys() if a_id not in accounts]
+    missing_accounts = record.manager.run_parallel([partial(IndivoAccount.get, a_id, summary=True)
+                                                    for a_id in missing_ids])
+    accounts.update(zip(missing_ids, missing_accounts))
+    for account_id, carenet_names in carenet_members.items():
+        for carenet_name in carenet_names:
+            shares.append((account_id, MirroredShare.CARENET, carenet_name))
+
+    return record, accounts.values(), shares
+
+@transaction.commit_on_success
+def save_record_graphs(graphs, after_save=None):
+    """ Write fetched record graphs to the mirror in one transaction.
+
+    Records and accounts are updated in place, and each record's shares replaced.
+    after_save is called inside the transaction, so progress can be saved with the data.
+
+    """
+    now = datetime.datetime.now()
+    saved_accounts = set()
+    for record, accounts, shares in graphs:
+        for account in accounts:
+            if account.account_id not in saved_accounts:
+                MirroredAccount(account_id=account.account_id,
+                                full_name=account.full_name or '',
+                                contact_email=account.contact_email or '',
+                                state=account.state or '',
+                                synced_at=now).save()
+                saved_accounts.add(account.account_id)
+
+        contact = record.contact
+        mirrored_record = MirroredRecord(record_id=record.record_id,
+                                         label=record.label or '',
+                                         full_name=contact.full_name or '',
+                                         given_name=contact.given_name or '',
+                                         family_name=contact.family_name or '',
+                                         email=contact.email or '',
+                                         street_address=contact.street_address or '',
+                                         postal_code=contact.postal_code or '',
+                                         region=contact.region or '',
+                                         country=contact.country or '',
+                                         phone_numbers='\n'.join([p for p in contact.phone_numbers if p]),
+                                         synced_at=now)
+        mirrored_record.save()
+
+        mirrored_record.shares.all().delete()
+        for account_id, kind, carenet_name in set(shares):
+            MirroredShare.objects.create(record=mirrored_record, account_id=account_id,
+                                         kind=kind, carenet_name=carenet_name)
+
+    if after_save:
+        after_save()
+
+@transaction.commit_on_success
+def prune_records(synced_before):
+    """ Delete the mirrored records (and their shares) a full sync didn't see.
+
+    Accounts are kept: Indivo retires accounts rather than deleting them.
+
+    """
+    records = MirroredRecord.objects.filter(synced_at__lt=synced_before)
+    count = records.count()
+    records.delete()
+    return count
+
+# While reads come from the mirror, the admin's own writes to Indivo are copied into it,
+# so they show up in searches before the next sync.
+
+def save_created_record(record):
+    """ Mirror a record just created in Indivo. """
+    if read_from_mirror():
+        save_record_graphs([(record, [], [])])
+
+@transaction.commit_on_success
+def save_share(record_id, account, kind, carenet_name=''):
+    """ Mirror a share just made in Indivo, if its record is mirrored.
+
+    A new owner replaces the record's old one.
+
+    """
+    if not read_from_mirror() or not MirroredRecord.objects.filter(pk=record_id).exists():
+        return
+    if kind == MirroredShare.OWNER:
+        MirroredShare.objects.filter(record=record_id, kind=kind).delete()
+    _save_account(account, datetime.datetime.now())
+    MirroredShare.objects.get_or_create(record_id=record_id, account_id=account.account_id,
+                                        kind=kind, carenet_name=carenet_name)
+
+@transaction.commit_on_success
+def delete_share(record_id, account_id, kind, carenet_name=''):
+    """ Remove a share just removed in Indivo from the mirror. """
+    if read_from_mirror():
+        MirroredShare.objects.filter(record=record_id, account=account_id, kind=kind,
+                                     carenet_name=carenet_name).delete()
+
+@transaction.commit_on_success
+def save_account(account):
+    """ Mirror an account just created or changed in Indivo. """
+    if read_from_mirror():
+        _save_account(account, datetime.datetime.now())
+
+def _save_account(account, now):
+    # keep what's mirrored of fields the account hasn't loaded
+    mirrored, created = MirroredAccount.objects.get_or_create(account_id=account.account_id,
+                                                              defaults={'synced_at': now})
+    for field in ('full_name', 'contact_email', 'state'):
+        value = getattr(account, field, None)
+        if value is not None or created:
+            setattr(mirrored, field, value or '')
+    mirrored.synced_at = now
+    mirrored.save()
+
+def search_records(search_string, offset=0, limit=None):
+    """ Mirrored records whose label starts with search_string, as (record_id, label). """
+    matches = MirroredRecord.objects.filter(label__istartswith=search_string).order_by('label')
+    matches = matches.values_list('record_id', 'label')
+    if limit is not None:
+        return matches[offset:offset + limit]
+    return matches[offset:]
+
+def search_accounts(full_name=None, contact_email=None):
+    """ Mirrored accounts whose name and/or contact email start with those given. """
+    query = Q()
+    if full_name:
+        query &= Q(full_name__istartswith=full_name)
+    if contact_email:
+        query &= Q(contact_email__istartswith=contact_email)
+    return MirroredAccount.objects.filter(query).order_by('full_name')
@@ -0,0 +1,94 @@
+"""
+Connection pooling for the Indivo client.
+
+"""
+
+from admin.lib.breaker import IndivoUnavailable
+from contextlib import contextmanager
+import threading
+import time
+
+class ClientPoolTimeout(IndivoUnavailable):
+    """ Every client was busy for longer than the pool's timeout. """
+    pass
+
+class ClientPool(object):
+    """ A thread-safe pool of Indivo clients for a single Indivo server.
+
+    Each client is checked out by one thread at a time, and returned to the pool
+    afterwards so the next call reuses it (and whatever connection it holds open)
+    instead of building a new one. At most max_in_use clients are checked out at once:
+    further callers wait up to timeout seconds for one to come back. At most size idle
+    clients are kept.
+
+    """
+
+    def __init__(self, factory, size=8, max_in_use=None, timeout=None):
+        self.factory = factory
+        self.size = size
+        self.max_in_use = max_in_use or size
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self._idle = []
+        self._in_use = 0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def client(self):
+        """ Check out a client for the duration of a with block.
+
+        A client whose call raised is discarded rather than returned to the pool.
+
+        """
+        client = self.acquire()
+        try:
+            yield client
+        except:
+            self.release(client, discard=True)
+            raise
+        else:
+            self.release(client)
+
+    def acquire(self):
+        with self._cond:
+            deadline = time.time() + self.timeout if self.timeout is not None else None
+            while self._in_use >= self.max_in_use:
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise ClientPoolTimeout("No Indivo connection available after %ss"%self.timeout)
+                    self._cond.wait(remaining)
+            self._in_use += 1
+
+            if self._idle:
+                self.hits += 1
+                return self._idle.pop()
+            self.misses += 1
+
+        # build new clients outside the lock
+        try:
+            return self.factory()
+        except:
+            self._return(None)
+            raise
+
+    def release(self, client, discard=False):
+        self._return(None if discard else client)
+
+    def _return(self, client):
+        with self._cond:
+            self._in_use -= 1
+            if client is not None and len(self._idle) < self.size:
+                self._idle.append(client)
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'idle': len(self._idle),
+                    'in_use': self._in_use,
+                    }
@@ -0,0 +1,59 @@
+"""
+Single-flight coalescing of identical concurrent calls.
+
+"""
+
+import threading
+
+class _Flight(object):
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight(object):
+    """ Share the work of identical calls that overlap in time.
+
+    The first thread to call do() with a key runs the function. Threads that call do()
+    with the same key while it runs wait for it, and get its result (or its exception)
+    instead of running the function again. Nothing is kept once the call finishes: a
+    later call runs the function afresh.
+
+    """
+
+    def __init__(self):
+        self.coalesced = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = func()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._flights)
@@ -0,0 +1,164 @@
+"""
+Statistics on the Indivo API calls made by the admin: per call, across the process,
+and rolled up per request.
+
+"""
+
+from collections import deque
+import bisect
+import math
+import threading
+
+# Upper bounds (in milliseconds) of the latency histogram's buckets
+LATENCY_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, float('inf')]
+
+# Number of recent latencies kept per call, to take percentiles over
+RECENT_SAMPLES = 1000
+
+def percentile(sorted_values, p):
+    """ The p-th percentile (nearest rank) of a sorted list, or None if it's empty. """
+    if not sorted_values:
+        return None
+    rank = int(math.ceil(p / 100.0 * len(sorted_values)))
+    return sorted_values[min(max(rank, 1), len(sorted_values)) - 1]
+
+class Timings(object):
+    """ Count, total, histogram and recent values of a series of latencies (in ms). """
+
+    __slots__ = ('count', 'total_ms', 'max_ms', 'histogram', 'recent')
+
+    def __init__(self):
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.histogram = [0] * len(LATENCY_BUCKETS)
+        self.recent = deque(maxlen=RECENT_SAMPLES)
+
+    def add(self, ms):
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+        self.histogram[bisect.bisect_left(LATENCY_BUCKETS, ms)] += 1
+        self.recent.append(ms)
+
+    def summary(self):
+        recent = sorted(self.recent)
+        return {
+            'count': self.count,
+            'mean_ms': self.total_ms / self.count if self.count else None,
+            'max_ms': self.max_ms,
+            'p50_ms': percentile(recent, 50),
+            'p95_ms': percentile(recent, 95),
+            'p99_ms': percentile(recent, 99),
+            'histogram': zip(LATENCY_BUCKETS, self.histogram),
+            }
+
+class CallStats(object):
+    """ Per-process statistics for each Indivo client function called. """
+
+    def __init__(self):
+        self._calls = {}
+        self._views = {}
+        self._lock = threading.Lock()
+
+    def record_call(self, client_func_name, ms, status, payload_bytes):
+        with self._lock:
+            call = self._calls.get(client_func_name)
+            if call is None:
+                call = self._calls[client_func_name] = {'timings': Timings(), 'statuses': {},
+                                                        'bytes': 0}
+            call['timings'].add(ms)
+            call['statuses'][status] = call['statuses'].get(status, 0) + 1
+            call['bytes'] += payload_bytes
+
+        request_stats = RequestStats.current()
+        if request_stats is not None:
+            request_stats.add(client_func_name, ms)
+
+    def record_request(self, view_name, request_stats):
+        """ Note the calls a request made, to see which views fan out the most. """
+        with self._lock:
+            view = self._views.get(view_name)
+            if view is None:
+                view = self._views[view_name] = {'requests': 0, 'calls': 0, 'max_calls': 0,
+                                                 'timings': Timings()}
+            view['requests'] += 1
+            view['calls'] += request_stats.count
+            view['max_calls'] = max(view['max_calls'], request_stats.count)
+            view['timings'].add(request_stats.total_ms)
+
+    def calls(self):
+        """ A summary of each client function's calls, slowest (by p95) first. """
+        with self._lock:
+            ret = []
+            for name, call in self._calls.items():
+                summary = call['timings'].summary()
+                summary.update({'name': name,
+                                'statuses': sorted(call['statuses'].items()),
+                                'bytes': call['bytes'],
+                                'mean_bytes': call['bytes'] / summary['count']})
+                ret.append(summary)
+        ret.sort(key=lambda s: s['p95_ms'], reverse=True)
+        return ret
+
+    def views(self):
+        """ A summary of the calls made by each view, most calls per request first. """
+        with self._lock:
+            ret = []
+            for name, view in self._views.items():
+                summary = view['timings'].summary()
+                summary.update({'name': name,
+                                'requests': view['requests'],
+                                'mean_calls': float(view['calls']) / view['requests'],
+                                'max_calls': view['max_calls']})
+                ret.append(summary)
+        ret.sort(key=lambda s: s['mean_calls'], reverse=True)
+        return ret
+
+    def reset(self):
+        with self._lock:
+            self._calls = {}
+            self._views = {}
+
+class RequestStats(object):
+    """ The Indivo API calls made while handling one request, from any thread. """
+
+    _local = threading.local()
+
+    def __init__(self):
+        self.count = 0
+        self.total_ms = 0.0
+        self.by_call = {}
+        self._lock = threading.Lock()
+
+    def add(self, client_func_name, ms):
+        with self._lock:
+            self.count += 1
+            self.total_ms += ms
+            count, total_ms = self.by_call.get(client_func_name, (0, 0.0))
+            self.by_call[client_func_name] = (count + 1, total_ms + ms)
+
+    def server_timing(self):
+        """ A Server-Timing header value: the total time in Indivo calls, then each call's. """
+        metrics = ['indivo;desc="Indivo API (%s calls)";dur=%.1f'%(self.count, self.total_ms)]
+        for name, (count, total_ms) in sorted(self.by_call.items()):
+            metrics.append('%s;desc="%s x%s";dur=%.1f'%(name, name, count, total_ms))
+        return ', '.join(metrics)
+
+    @classmethod
+    def activate(cls, request_stats=None):
+        """ Make request_stats (or a new RequestStats) the current thread's, and return it. """
+        if request_stats is None:
+            request_stats = cls()
+        cls._local.current = request_stats
+        return request_stats
+
+    @classmethod
+    def deactivate(cls):
+        cls._local.current = None
+
+    @classmethod
+    def current(cls):
+        return getattr(cls._local, 'current', None)
+
+call_stats = CallStats()
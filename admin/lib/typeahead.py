@@ -0,0 +1,80 @@
+"""
+Typeahead search of record labels, answered from a local index.
+
+"""
+
+from django.conf import settings
+from collections import OrderedDict
+import bisect
+import threading
+
+class PrefixIndex(object):
+    """ A bounded, thread-safe index of (label, record_id), answering label prefix queries.
+
+    Labels are kept in a sorted array, so a query is a binary search followed by a scan of
+    the matches. Matching ignores case. Beyond max_entries, the records least recently
+    added (or refreshed) are dropped. If max_entries isn't given, it's read from
+    settings.RECORD_TYPEAHEAD when needed.
+
+    """
+
+    def __init__(self, max_entries=None):
+        self._max_entries = max_entries
+        self._keys = []
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def max_entries(self):
+        if self._max_entries is not None:
+            return self._max_entries
+        return getattr(settings, 'RECORD_TYPEAHEAD', {}).get('MAX_ENTRIES', 10000)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, record_id, label):
+        if not record_id or not label:
+            return
+        key = (label.lower(), record_id, label)
+        with self._lock:
+            old_key = self._entries.pop(record_id, None)
+            if old_key is not None and old_key != key:
+                self._remove_key(old_key)
+            if old_key != key:
+                bisect.insort(self._keys, key)
+            self._entries[record_id] = key
+
+            max_entries = self.max_entries
+            while len(self._entries) > max_entries:
+                evicted_id, evicted_key = self._entries.popitem(last=False)
+                self._remove_key(evicted_key)
+
+    def remove(self, record_id):
+        with self._lock:
+            key = self._entries.pop(record_id, None)
+            if key is not None:
+                self._remove_key(key)
+
+    def search(self, prefix, limit=10):
+        """ The (record_id, label) of up to limit records whose labels start with prefix. """
+        prefix = prefix.lower()
+        matches = []
+        with self._lock:
+            i = bisect.bisect_left(self._keys, (prefix,))
+            while i < len(self._keys) and len(matches) < limit:
+                label_key, record_id, label = self._keys[i]
+                if not label_key.startswith(prefix):
+                    break
+                matches.append((record_id, label))
+                i += 1
+        return matches
+
+    def _remove_key(self, key):
+        i = bisect.bisect_left(self._keys, key)
+        if i < len(self._keys) and self._keys[i] == key:
+            del self._keys[i]
+
+# Filled as searches and record views load labels from Indivo, so the typeahead costs
+# Indivo nothing of its own
+record_index = PrefixIndex()
@@ -2,11 +2,14 @@
 Utilities for the Indivo admin tool
 """
 
+from django.conf import settings
 from django.http import HttpResponseNotAllowed
 from django.shortcuts import render_to_response
 from django.template import RequestContext
+from django.template.loader import get_template
 from django.contrib.auth.models import User
 from django.forms.util import ErrorList
+from django.utils.encoding import force_unicode
 
 # taken from pointy-stick.com with some modifications
 class MethodDispatcher(object):
@@ -30,15 +33,87 @@ class MethodDispatcher(object):
 def render_admin_response(request, template_path, context={}):
 
     # add in the User and recent Records to all admin Contexts
-    recents = request.session.get('recent_records', set([]))
+    recents = get_recent_records(request)
     admin_context = {'recents':recents,
                      'user':request.user}
     admin_context.update(context)
     return render_to_response(template_path, admin_context,
                               context_instance=RequestContext(request))
 
+# Where the rows go in the streamed record_list.html
+STREAMED_ROWS_MARKER = '<!-- records -->'
+
+def stream_record_list(request, records, search_string, page, page_size):
+    """ Render the record list page incrementally, yielding each row as it's ready.
+
+    The page around the rows is rendered with a marker where the rows go. Its head is
+    sent first, then the rows, then its tail. records can hold one record more than
+    page_size, to tell whether there's a next page: the tail is rendered once that's known.
+
+    """
+    context = {'recents': get_recent_records(request),
+               'user': request.user,
+               'search_string': search_string,
+               'page': page,
+               'previous_page': page - 1,
+               'next_page': None,
+               'streaming': True}
+    template = get_template('record_list.html')
+    yield template.render(RequestContext(request, context)).split(STREAMED_ROWS_MARKER, 1)[0]
+
+    row_template = get_template('_record_row.html')
+    for i, record in enumerate(records):
+        if i == page_size:
+            context['next_page'] = page + 1
+            break
+        yield row_template.render(RequestContext(request, {'record': record}))
+    yield template.render(RequestContext(request, context)).split(STREAMED_ROWS_MARKER, 1)[1]
+
+def get_recent_records(request):
+    """ The (record_id, label) pairs of recently viewed records, most recent first. """
+    recents = request.session.get('recent_records', [])
+
+    # older sessions stored a set of IndivoRecords: only plain pairs are kept now
+    if not isinstance(recents, list):
+        return []
+    return [r for r in recents if isinstance(r, tuple) and len(r) == 2]
+
+def add_recent_record(request, record):
+    """ Move a record to the front of the recently viewed records.
+
+    The session is only written if that changes the list. Only plain strings go in the
+    session, never model objects, so changes to the models can't break its unpickling.
+
+    """
+    entry = (force_unicode(record.record_id), force_unicode(record.label or ''))
+    recents = get_recent_records(request)
+    if recents[:1] == [entry]:
+        return
+
+    limit = getattr(settings, 'RECENT_RECORDS_LIMIT', 10)
+    recents = [entry] + [r for r in recents if r[0] != record.record_id]
+    request.session['recent_records'] = recents[:limit]
+
+# The User columns the user list shows (see _user.html)
+USER_LIST_FIELDS = ('username', 'first_name', 'last_name', 'email', 'is_active', 'is_superuser')
+
+def get_user_filters(request):
+    """ The username, email and active filters on the user list, from the GET parameters. """
+    filters = dict((name, request.GET.get(name, '').strip()) for name in ('username', 'email', 'active'))
+    if filters['active'] not in ('1', '0'):
+        filters['active'] = ''
+    return filters
+
 def get_users_to_manage(request):
-    users = User.objects.all().order_by('username')
+    """ The users to list, matching the request's filters, loading only the columns shown. """
+    filters = get_user_filters(request)
+    users = User.objects.only(*USER_LIST_FIELDS).order_by('username')
+    if filters['username']:
+        users = users.filter(username__istartswith=filters['username'])
+    if filters['email']:
+        users = users.filter(email__istartswith=filters['email'])
+    if filters['active']:
+        users = users.filter(is_active=(filters['active'] == '1'))
     return users
 
 def append_error_to_form(form, field_name, error_text):
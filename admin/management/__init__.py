@@ -0,0 +1,75 @@
+"""
+Indexes for the admin's queries that syncdb doesn't create from the models, created after it.
+
+"""
+
+from django.contrib.auth import models as auth_models
+from admin import models as admin_models
+from django.db import connection, transaction
+from django.db.models.signals import post_syncdb
+
+def index_exists(table, name):
+    """ Whether table has an index called name, or None if the backend can't tell us. """
+    cursor = connection.cursor()
+    if connection.vendor == 'postgresql':
+        cursor.execute("SELECT 1 FROM pg_indexes WHERE tablename = %s AND indexname = %s",
+                       [table, name])
+    elif connection.vendor == 'sqlite':
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND tbl_name = %s "
+                       "AND name = %s", [table, name])
+    elif connection.vendor == 'mysql':
+        cursor.execute("SHOW INDEX FROM %s WHERE Key_name = %%s"%connection.ops.quote_name(table),
+                       [name])
+    elif connection.vendor == 'oracle':
+        cursor.execute("SELECT 1 FROM user_indexes WHERE index_name = UPPER(%s)", [name])
+    else:
+        return None
+    return cursor.fetchone() is not None
+
+def create_indexes(table, indexes, verbosity=1):
+    """ Create each (name, indexed columns) index that table doesn't have yet. """
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    for name, columns in indexes:
+        exists = index_exists(table, name)
+        if exists is None:
+            if verbosity >= 1:
+                print "Not installing index %s: can't tell whether it exists on this database"%name
+            continue
+        if not exists:
+            cursor.execute('CREATE INDEX %s ON %s (%s)'%(qn(name), qn(table), columns))
+            if verbosity >= 1:
+                print "Installing index %s"%name
+    transaction.commit_unless_managed()
+
+def user_list_indexes():
+    """ (name, indexed columns) of the auth_user indexes behind the user list's filters. """
+    qn = connection.ops.quote_name
+    indexes = [('auth_user_active_username', '%s, %s'%(qn('is_active'), qn('username')))]
+    if connection.vendor == 'postgresql':
+        # istartswith filters compile to UPPER(column::text) LIKE UPPER('PREFIX%'), which
+        # only an index on the same expression can answer
+        indexes += [('auth_user_username_prefix', 'UPPER(%s::text) text_pattern_ops'%qn('username')),
+                    ('auth_user_email_prefix', 'UPPER(%s::text) text_pattern_ops'%qn('email'))]
+    return indexes
+
+def create_user_indexes(sender, verbosity=1, **kwargs):
+    create_indexes(auth_models.User._meta.db_table, user_list_indexes(), verbosity)
+
+def create_mirror_indexes(sender, verbosity=1, **kwargs):
+    """ Indexes for the mirror's prefix searches, which istartswith runs as above.
+
+    Other backends answer them from the columns' own indexes, or can't use one at all.
+
+    """
+    if connection.vendor != 'postgresql':
+        return
+    qn = connection.ops.quote_name
+    for model, fields in [(admin_models.MirroredRecord, ['label']),
+                          (admin_models.MirroredAccount, ['full_name', 'contact_email'])]:
+        table = model._meta.db_table
+        create_indexes(table, [('%s_%s_prefix'%(table, field), 'UPPER(%s::text) text_pattern_ops'%qn(field))
+                               for field in fields], verbosity)
+
+post_syncdb.connect(create_user_indexes, sender=auth_models)
+post_syncdb.connect(create_mirror_indexes, sender=admin_models)
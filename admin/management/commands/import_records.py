@@ -0,0 +1,117 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+from admin.forms import RecordForm
+from admin.lib.indivo import IndivoModel, IndivoRecord, IndivoAccount, IndivoContact
+from admin.lib.bulk import read_rows, run_bulk, Checkpoint, BulkReport
+import copy
+import os
+
+class Command(BaseCommand):
+    args = '<file>'
+    help = ('Creates an Indivo record for each contact in a CSV or JSONL file, with the columns '
+            'of the record form (full_name, email, street_address, postal_code, country, phone_number)')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format',
+                    action='store',
+                    dest='format',
+                    default=None,
+                    help="'csv' or 'jsonl' (default: guessed from the file's extension)"),
+        make_option('--owner',
+                    action='store',
+                    dest='owner',
+                    default=None,
+                    help="Account id to own the new records (default: settings.DEFAULT_ADMIN_OWNER)"),
+        make_option('--workers',
+                    action='store',
+                    type='int',
+                    dest='workers',
+                    default=None,
+                    help="Number of rows to import at once (default: settings.INDIVO_API_MAX_WORKERS, "
+                         "at most settings.INDIVO_API_MAX_CONCURRENT)"),
+        make_option('--rate',
+                    action='store',
+                    type='float',
+                    dest='rate',
+                    default=None,
+                    help="Start at most this many rows per second"),
+        make_option('--checkpoint',
+                    action='store',
+                    dest='checkpoint',
+                    default=None,
+                    help="File to record progress in, and resume from (default: <file>.checkpoint)"),
+        )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Usage: import_records %s'%self.args)
+        path = args[0]
+        if not os.path.exists(path):
+            raise CommandError("No such file: %s"%path)
+
+        verbosity = int(options['verbosity'])
+        workers = options['workers'] or IndivoModel.manager.max_workers
+        checkpoint = Checkpoint(options['checkpoint'] or path + '.checkpoint')
+
+        if options['owner']:
+            owner = IndivoAccount(account_id=options['owner'])
+        else:
+            owner = IndivoAccount.DEFAULT()
+
+        report = BulkReport('rows')
+        if verbosity and len(checkpoint):
+            print "Resuming from %s..."%checkpoint.path
+
+        def pending_rows():
+            for row_number, row in read_rows(path, options['format']):
+                progress = checkpoint.get(row_number)
+                if progress and progress[-1] == 'owned':
+                    report.skip(row_number, progress[0])
+                else:
+                    yield row_number, row
+
+        def import_row(item):
+            row_number, row = item
+            progress = checkpoint.get(row_number)
+            if progress:
+                # created last time round, but the owner wasn't set
+                record = IndivoRecord(record_id=progress[0])
+            else:
+                record = IndivoRecord.from_contact(IndivoContact(contact_data(row)))
+                record.push()
+                checkpoint.save(row_number, record.record_id, 'created')
+
+            record.set_owner(owner)
+            checkpoint.save(row_number, record.record_id, 'owned')
+            return record.record_id
+
+        try:
+            for (row_number, row), record_id, error in run_bulk(import_row, pending_rows(), 
+                                                                workers=workers, 
+                                                                rate=options['rate']):
+                report.add(row_number, record_id, error)
+                if verbosity > 1:
+                    print "\trow %s: %s"%(row_number, error or record_id)
+                elif verbosity and report.finished % 100 == 0:
+                    print "\t%s"%report.summary()
+        finally:
+            checkpoint.close()
+
+        print "Created records (row, record_id):"
+        for row_number, record_id in sorted(report.skipped + report.results):
+            print "%s\t%s"%(row_number, record_id)
+        if report.errors:
+            print "Errors:"
+            for line in report.error_lines():
+                print "\trow %s"%line
+        print report.summary()
+
+def contact_data(row):
+    """ Validate a row as the record form would, returning the data for an IndivoContact. """
+    form = RecordForm(row)
+    if not form.is_valid():
+        raise ValueError('; '.join(['%s: %s'%(field, ' '.join(errors)) 
+                                    for field, errors in form.errors.items()]))
+    data = copy.copy(form.cleaned_data)
+    data['phone_numbers'] = [data.pop('phone_number')]
+    return data
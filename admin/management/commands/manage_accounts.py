@@ -0,0 +1,120 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+from admin.lib.indivo import IndivoModel, IndivoAccount, AccountIdTaken
+from admin.lib.bulk import read_rows, run_bulk, BulkReport
+import os
+
+class Command(BaseCommand):
+    args = 'create|retire <file>'
+    help = ('Creates or retires the Indivo accounts listed in a CSV or JSONL file. Accounts are '
+            'created from full_name and email columns (with the email as the account id, unless '
+            'there is an account_id column), and retired by their account_id (or email) column')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format',
+                    action='store',
+                    dest='format',
+                    default=None,
+                    help="'csv' or 'jsonl' (default: guessed from the file's extension)"),
+        make_option('--workers',
+                    action='store',
+                    type='int',
+                    dest='workers',
+                    default=None,
+                    help="Number of accounts to handle at once (default: settings.INDIVO_API_MAX_WORKERS, "
+                         "at most settings.INDIVO_API_MAX_CONCURRENT)"),
+        make_option('--rate',
+                    action='store',
+                    type='float',
+                    dest='rate',
+                    default=None,
+                    help="Handle at most this many accounts per second"),
+        make_option('--output',
+                    action='store',
+                    dest='output',
+                    default=None,
+                    help="File to write the new accounts' secondary secrets to (readable only by you)"),
+        )
+
+    def handle(self, *args, **options):
+        if len(args) != 2 or args[0] not in ('create', 'retire'):
+            raise CommandError('Usage: manage_accounts %s'%self.args)
+        action, path = args
+        if not os.path.exists(path):
+            raise CommandError("No such file: %s"%path)
+
+        output = options['output']
+        if output and os.path.exists(output):
+            raise CommandError("Not overwriting %s"%output)
+
+        verbosity = int(options['verbosity'])
+        workers = options['workers'] or IndivoModel.manager.max_workers
+        func = create_account if action == 'create' else retire_account
+        report = BulkReport('accounts')
+
+        for (row_number, row), result, error in run_bulk(func, read_rows(path, options['format']),
+                                                         workers=workers, rate=options['rate']):
+            if isinstance(error, AccountIdTaken):
+                report.skip(row_number, account_id_for(row))
+            else:
+                report.add(row_number, result, error)
+            if verbosity > 1:
+                print "\trow %s: %s"%(row_number, error or 'ok')
+            elif verbosity and report.finished and report.finished % 100 == 0:
+                print "\t%s"%report.summary()
+
+        if action == 'create':
+            # secrets stay out of stdout, which tends to end up in logs
+            print "Created accounts (row, account_id):"
+            for row_number, account in sorted(report.results):
+                print "%s\t%s"%(row_number, account.account_id)
+            if output:
+                write_secrets(output, sorted(report.results))
+                print "Secondary secrets written to %s"%output
+            elif report.results:
+                print "Secondary secrets not saved: use --output to write them to a file"
+            if report.skipped:
+                print "Already taken (row, account_id):"
+                for row_number, account_id in sorted(report.skipped):
+                    print "%s\t%s"%(row_number, account_id)
+        if report.errors:
+            print "Errors:"
+            for line in report.error_lines():
+                print "\trow %s"%line
+        print report.summary()
+
+def write_secrets(path, results):
+    """ Write (row, account_id, secondary_secret) lines to a new file only the owner can read. """
+    f = os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600), 'w')
+    try:
+        for row_number, account in results:
+            f.write("%s\t%s\t%s\n"%(row_number, account.account_id, account.secondary_secret or ''))
+    finally:
+        f.close()
+
+def account_id_for(row):
+    return (row.get('account_id') or row.get('email') or '').strip()
+
+def create_account(item):
+    row_number, row = item
+    account_id = account_id_for(row)
+    if not account_id or not row.get('full_name'):
+        raise ValueError("full_name and email are required")
+
+    # a new account: nothing to fetch before creating it
+    account = IndivoAccount(account_id=account_id, 
+                            full_name=row['full_name'], 
+                            contact_email=row.get('email') or account_id)
+    account.push()
+    return account
+
+def retire_account(item):
+    row_number, row = item
+    account_id = account_id_for(row)
+    if not account_id:
+        raise ValueError("account_id is required")
+
+    # retiring only needs the id, not the account info or record lists
+    account = IndivoAccount(account_id=account_id)
+    account.retire()
+    return account_id
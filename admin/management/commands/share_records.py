@@ -0,0 +1,67 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+from admin.lib.indivo import IndivoModel
+from admin.lib.bulk import change_shares, BulkReport
+import os
+
+class Command(BaseCommand):
+    args = '<record_ids_file> <account_ids_file>'
+    help = ('Grants (or revokes) a full share of every record listed in one file to every account '
+            'listed in the other, with one id per line')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--revoke',
+                    action='store_true',
+                    dest='revoke',
+                    default=False,
+                    help="Revoke the shares instead of granting them"),
+        make_option('--workers',
+                    action='store',
+                    type='int',
+                    dest='workers',
+                    default=None,
+                    help="Number of shares to change at once (default: settings.INDIVO_API_MAX_WORKERS, "
+                         "at most settings.INDIVO_API_MAX_CONCURRENT)"),
+        make_option('--rate',
+                    action='store',
+                    type='float',
+                    dest='rate',
+                    default=None,
+                    help="Change at most this many shares per second"),
+        )
+
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError('Usage: share_records %s'%self.args)
+        record_ids, account_ids = [read_ids(path) for path in args]
+
+        verbosity = int(options['verbosity'])
+        workers = options['workers'] or IndivoModel.manager.max_workers
+        report = BulkReport('shares')
+
+        for (record_id, account_id), result, error in change_shares(record_ids, account_ids,
+                                                                    revoke=options['revoke'],
+                                                                    workers=workers,
+                                                                    rate=options['rate']):
+            report.add('%s %s'%(record_id, account_id), result, error)
+            if verbosity > 1:
+                print "\t%s %s: %s"%(record_id, account_id, error or 'ok')
+
+        if report.errors:
+            print "Errors (record account: error):"
+            for line in report.error_lines():
+                print "\t%s"%line
+        print report.summary()
+
+def read_ids(path):
+    if not os.path.exists(path):
+        raise CommandError("No such file: %s"%path)
+    ids = []
+    seen = set()
+    with open(path) as f:
+        for line in f:
+            id = line.strip()
+            if id and id not in seen:
+                seen.add(id)
+                ids.append(id)
+    return ids
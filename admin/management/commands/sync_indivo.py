@@ -0,0 +1,111 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+from admin.lib.indivo import IndivoModel, IndivoRecord, IndivoFuture, IdentityMap
+from admin.lib import mirror
+from admin.models import MirrorSyncState
+import datetime
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Mirrors Indivo records, accounts and shares into the admin database'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--search',
+                    action='store',
+                    dest='search_string',
+                    default='',
+                    help="Only mirror records whose labels match this search"),
+        make_option('--batch-size',
+                    action='store',
+                    type='int',
+                    dest='batch_size',
+                    default=100,
+                    help="Number of records to fetch and save per batch"),
+        make_option('--max-records',
+                    action='store',
+                    type='int',
+                    dest='max_records',
+                    default=1000000,
+                    help="Stop a pass after this many records, in case Indivo keeps sending more"),
+        make_option('--restart',
+                    action='store_true',
+                    dest='restart',
+                    default=False,
+                    help="Start from the first record, rather than where the last run stopped"),
+        )
+
+    def handle(self, *args, **options):
+        verbosity = int(options['verbosity'])
+        search_string = options['search_string']
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError('--batch-size must be at least 1')
+        if options['max_records'] < 1:
+            raise CommandError('--max-records must be at least 1')
+
+        # Indivo can't tell us what's changed since the last run, so each run is a full pass
+        # over the search: it only resumes part way through if the last one was interrupted
+        state, created = MirrorSyncState.objects.get_or_create(search_string=search_string)
+        if options['restart'] or not state.offset:
+            state.offset = 0
+            state.pass_started_at = datetime.datetime.now()
+            state.save()
+        elif verbosity:
+            print "Resuming from record %s..."%state.offset
+
+        manager = IndivoModel.manager
+        synced = 0
+        previous_ids = None
+        complete = False
+        while True:
+            if state.offset >= options['max_records']:
+                print "Stopping at --max-records=%s: is Indivo paging record searches?"%options['max_records']
+                break
+
+            records = IndivoRecord.search_page(search_string, state.offset, batch_size)
+            if len(records) > batch_size:
+                # Indivo ignored the paging parameters and sent every match
+                records = records[state.offset:state.offset + batch_size]
+
+            # an Indivo that ignores the paging parameters sends the first page for every
+            # offset: stop once a batch brings nothing new
+            record_ids = set([record.record_id for record in records])
+            if previous_ids is not None and records and record_ids <= previous_ids:
+                break
+            if not records:
+                complete = True
+                break
+            previous_ids = record_ids
+
+            # accounts shared across the batch are fetched once
+            IdentityMap.activate()
+            try:
+                graphs = IndivoFuture.gather([manager.submit(mirror.fetch_record_graph, record)
+                                              for record in records])
+            finally:
+                IdentityMap.deactivate()
+
+            # save progress in the same transaction as the batch, so a failed run resumes here
+            state.offset += len(records)
+            mirror.save_record_graphs(graphs, after_save=state.save)
+            synced += len(records)
+            if verbosity:
+                print "\tMirrored %s records"%synced
+
+            if len(records) < batch_size:
+                complete = True
+                break
+
+        # a full pass over every record has seen all that's left in Indivo. Only trust one
+        # that found records and ran out of them: an empty or cut short answer shouldn't
+        # empty the mirror.
+        if complete and state.offset and not search_string and state.pass_started_at:
+            pruned = mirror.prune_records(state.pass_started_at)
+            if verbosity:
+                print "\tRemoved %s records no longer in Indivo"%pruned
+
+        # finished: the next run starts a fresh pass
+        state.offset = 0
+        state.save()
+        if verbosity:
+            print "Done."
@@ -0,0 +1,65 @@
+"""
+Middleware for the Indivo admin tool
+"""
+
+from admin.lib.indivo import IndivoModel, IdentityMap
+from admin.lib.breaker import IndivoUnavailable
+from admin.lib.utils import render_admin_response
+from admin.lib.stats import call_stats, RequestStats
+
+class IndivoIdentityMapMiddleware(object):
+    """ Scope the IndivoModel identity map to a single request. """
+
+    def process_request(self, request):
+        IdentityMap.activate()
+
+    def process_response(self, request, response):
+        identity_map = IdentityMap.current()
+        if identity_map is not None:
+            identity_map.clear()
+        IdentityMap.deactivate()
+        return response
+
+class IndivoCallStatsMiddleware(object):
+    """ Roll up the Indivo API calls made for each request.
+
+    The number of calls and the time spent in them are sent back in the X-Indivo-Calls
+    and Server-Timing headers, and added to the per-view statistics.
+
+    """
+
+    def process_request(self, request):
+        request._indivo_view_name = None
+        RequestStats.activate()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # name the view a MethodDispatcher would dispatch to
+        if hasattr(view_func, 'resolve'):
+            view_func = view_func.resolve(request)
+        request._indivo_view_name = getattr(view_func, '__name__', None)
+
+    def process_response(self, request, response):
+        request_stats = RequestStats.current()
+        RequestStats.deactivate()
+        if request_stats is not None:
+            response['X-Indivo-Calls'] = str(request_stats.count)
+            response['Server-Timing'] = request_stats.server_timing()
+            view_name = getattr(request, '_indivo_view_name', None)
+            if view_name:
+                call_stats.record_request(view_name, request_stats)
+        return response
+
+class IndivoUnavailableMiddleware(object):
+    """ Answer with a 503 error page when Indivo can't be reached, rather than a 500. """
+
+    def process_exception(self, request, exception):
+        if not isinstance(exception, IndivoUnavailable):
+            return None
+        response = render_admin_response(request, 'unavailable.html', {
+            'error': exception,
+        })
+        response.status_code = 503
+        retry_after = IndivoModel.manager.breaker.retry_after()
+        if retry_after:
+            response['Retry-After'] = str(retry_after)
+        return response
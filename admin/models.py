@@ -1,3 +1,60 @@
 from django.db import models
 
-# Create your models here.
+# Local mirror of the Indivo records, accounts and shares the admin manages,
+# kept up to date by the sync_indivo management command.
+
+class MirroredAccount(models.Model):
+    account_id = models.CharField(max_length=255, primary_key=True)
+    full_name = models.CharField(max_length=255, blank=True, db_index=True)
+    contact_email = models.CharField(max_length=255, blank=True, db_index=True)
+    state = models.CharField(max_length=50, blank=True)
+    synced_at = models.DateTimeField(db_index=True)
+
+    def __unicode__(self):
+        return self.account_id
+
+class MirroredRecord(models.Model):
+    record_id = models.CharField(max_length=255, primary_key=True)
+    label = models.CharField(max_length=255, blank=True, db_index=True)
+    full_name = models.CharField(max_length=255, blank=True)
+    given_name = models.CharField(max_length=255, blank=True)
+    family_name = models.CharField(max_length=255, blank=True)
+    email = models.CharField(max_length=255, blank=True)
+    street_address = models.CharField(max_length=255, blank=True)
+    postal_code = models.CharField(max_length=50, blank=True)
+    region = models.CharField(max_length=255, blank=True)
+    country = models.CharField(max_length=255, blank=True)
+    phone_numbers = models.TextField(blank=True) # one per line
+    synced_at = models.DateTimeField(db_index=True)
+
+    def __unicode__(self):
+        return self.label or self.record_id
+
+class MirroredShare(models.Model):
+    """ An account's access to a record: as its owner, a full share or a carenet member. """
+
+    OWNER = 'owner'
+    FULL = 'full'
+    CARENET = 'carenet'
+    KIND_CHOICES = (
+        (OWNER, 'Owner'),
+        (FULL, 'Full Share'),
+        (CARENET, 'Carenet Share'),
+    )
+
+    record = models.ForeignKey(MirroredRecord, related_name='shares')
+    account = models.ForeignKey(MirroredAccount, related_name='shares')
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES, db_index=True)
+    carenet_name = models.CharField(max_length=255, blank=True)
+
+    class Meta:
+        unique_together = (('record', 'account', 'kind', 'carenet_name'),)
+
+class MirrorSyncState(models.Model):
+    """ How far through a search's results sync_indivo has got, so it can resume. """
+
+    search_string = models.CharField(max_length=255, unique=True)
+    offset = models.IntegerField(default=0)
+    # when the pass in progress started: records not synced since are gone from Indivo
+    pass_started_at = models.DateTimeField(null=True)
+    updated_at = models.DateTimeField(auto_now=True)
@@ -6,6 +6,11 @@ Replace these with more appropriate tests for your application.
 """
 
 from django.test import TestCase
+from django.conf import settings
+from django.core.management import call_command
+from django.utils import simplejson
+from django.template.loader import get_template
+from django.template import Context
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -21,3 +26,874 @@ Another way to test that 1 + 1 is equal to 2.
 True
 """}
 
+
+from admin.lib.indivo import IndivoModel, IndivoRecord, IndivoAccount, IndivoContact, iter_elements, is_xml, \
+    AccountIdTaken, IndivoFuture, IdentityMap, MAX_POOL_DEPTH, _Dispatch
+from admin.middleware import IndivoIdentityMapMiddleware
+from admin.lib.cache import ResponseCache, LocalCacheBackend
+from admin.lib.pool import ClientPool, ClientPoolTimeout
+from admin.lib.utils import add_recent_record, get_recent_records
+from admin.lib.typeahead import PrefixIndex, record_index
+from admin.lib import mirror
+from admin.lib.bulk import run_bulk, Checkpoint, change_shares
+from admin.models import MirroredRecord, MirroredShare
+from admin.management import index_exists, create_user_indexes
+from admin.benchmarks.standin import StandInIndivo, StandInClient
+from admin.lib.stats import call_stats, percentile, RequestStats
+from admin.forms import BulkShareForm
+from admin.lib.breaker import CircuitBreaker, IndivoUnavailable, IndivoTimeout
+from functools import partial
+import datetime
+import socket
+import threading
+import time
+from django.contrib.auth.models import User
+from lxml import etree
+
+class FakeIndivoClient(object):
+    """ Answers Indivo API calls from canned XML, recording every call made. """
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.calls = []
+
+    def __getattr__(self, name):
+        if name not in self.responses:
+            raise AttributeError(name)
+        def api_call(*args, **kwargs):
+            self.calls.append(name)
+            if isinstance(self.responses[name], Exception):
+                raise self.responses[name]
+            status, data = self.responses[name]
+            return {'response_status': status, 'response_data': data}
+        return api_call
+
+class IndivoModelTestCase(TestCase):
+    responses = {
+        'read_special_document': (200, '<Contact xmlns="http://indivo.org/vocab/xml/documents#"><name><fullName>Jane Doe</fullName></name></Contact>'),
+        'read_record': (200, '<Record id="r1" label="Jane Doe"/>'),
+        'get_record_owner': (200, '<Account id="owner@example.org"/>'),
+        'get_shares': (200, '<Shares><Share account="guardian@example.org"/></Shares>'),
+        'get_record_carenets': (200, '<Carenets/>'),
+        'account_info': (200, '<Account id="guardian@example.org"><fullName>Guardian</fullName><state>active</state></Account>'),
+        'get_account_records': (200, '<Records/>'),
+        'delete_share': (200, ''),
+        'create_account': (400, 'Account ID already exists'),
+        }
+
+    def setUp(self):
+        self.pool_backup = IndivoModel.manager.pool
+        self.fake_client = FakeIndivoClient(self.responses)
+        IndivoModel.manager.pool = ClientPool(lambda: self.fake_client)
+
+    def tearDown(self):
+        IndivoModel.manager.pool = self.pool_backup
+
+class LazyRecordTest(IndivoModelTestCase):
+    def test_construction_makes_no_calls(self):
+        IndivoRecord(record_id='r1')
+        self.failUnlessEqual(self.fake_client.calls, [])
+
+    def test_label_fetches_only_contact(self):
+        record = IndivoRecord(record_id='r1')
+        self.failUnlessEqual(record.label, 'Jane Doe')
+        self.failUnlessEqual(self.fake_client.calls, ['read_special_document'])
+
+    def test_share_delete_is_one_call(self):
+        record = IndivoRecord(record_id='r1')
+        record.remove_fullshare_with(IndivoAccount(account_id='guardian@example.org'))
+        self.failUnlessEqual(self.fake_client.calls, ['delete_share'])
+
+class CarenetShareTest(IndivoModelTestCase):
+    responses = dict(IndivoModelTestCase.responses,
+                     get_record_carenets=(200, '<Carenets><Carenet id="c1" name="Family"/></Carenets>'),
+                     get_carenet_accounts=(200, '<CarenetAccounts><CarenetAccount id="guardian@example.org"/>'
+                                                '<CarenetAccount id="owner@example.org"/></CarenetAccounts>'))
+
+    def setUp(self):
+        super(CarenetShareTest, self).setUp()
+        # answer for whichever account is asked about
+        def account_info(account_id):
+            self.fake_client.calls.append('account_info')
+            return {'response_status': 200, 'response_data': '<Account id="%s"><fullName>%s</fullName>'
+                    '<state>active</state></Account>'%(account_id, account_id.split('@')[0].title())}
+        self.fake_client.account_info = account_info
+
+    def test_members_reuse_loaded_accounts(self):
+        record = IndivoRecord(record_id='r1')
+        self.failUnlessEqual(record.fullshares['guardian@example.org'].full_name, 'Guardian')
+        self.failUnlessEqual(record.owner.full_name, 'Owner')
+        account_calls = self.fake_client.calls.count('account_info')
+
+        members = record.carenetshares
+        self.failUnlessEqual(self.fake_client.calls.count('account_info'), account_calls)
+        self.failUnlessEqual(sorted([member.full_name for member in members]),
+                             ['Guardian (Family)', 'Owner (Family)'])
+
+        # the labels are on copies
+        self.failUnlessEqual(record.fullshares['guardian@example.org'].full_name, 'Guardian')
+        self.failUnlessEqual(record.owner.full_name, 'Owner')
+
+class AccountTest(IndivoModelTestCase):
+    def test_taken_account_id(self):
+        account = IndivoAccount(account_id='guardian@example.org', full_name='Guardian')
+        self.assertRaises(AccountIdTaken, account.push)
+        self.failUnlessEqual(self.fake_client.calls, ['create_account'])
+
+class AccountCreateTest(IndivoModelTestCase):
+    responses = dict(IndivoModelTestCase.responses,
+                     create_account=(200, '<Account id="new@example.org"><secret>abc123</secret></Account>'))
+
+    def test_other_bad_requests_arent_taken_ids(self):
+        self.fake_client.responses = dict(self.responses, create_account=(400, 'Invalid contact_email'))
+        account = IndivoAccount(account_id='new@example.org', full_name='New')
+        try:
+            account.push()
+        except AccountIdTaken:
+            self.fail("a validation error was reported as a taken account id")
+        except ValueError:
+            pass
+
+    def test_secrets_only_go_to_output(self):
+        import os, sys, tempfile
+        from StringIO import StringIO
+        directory = tempfile.mkdtemp()
+        rows, output = os.path.join(directory, 'accounts.csv'), os.path.join(directory, 'secrets.tsv')
+        with open(rows, 'w') as f:
+            f.write('full_name,email\nNew Account,new@example.org\n')
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            call_command('manage_accounts', 'create', rows, output=output, verbosity=0)
+            printed = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        try:
+            self.failIf('abc123' in printed)
+            self.failUnlessEqual(open(output).read(), '1\tnew@example.org\tabc123\n')
+            self.failUnlessEqual(os.stat(output).st_mode & 0777, 0600)
+        finally:
+            os.remove(rows)
+            os.remove(output)
+            os.rmdir(directory)
+
+class DefaultOwnerTest(IndivoModelTestCase):
+    def setUp(self):
+        super(DefaultOwnerTest, self).setUp()
+        IndivoModel.manager.default_account_id = None
+
+    def tearDown(self):
+        IndivoModel.manager.default_account_id = None
+        super(DefaultOwnerTest, self).tearDown()
+
+    def test_default_owner_is_cached(self):
+        account = IndivoAccount.DEFAULT()
+        self.failUnlessEqual(self.fake_client.calls, ['account_info'])
+        self.failUnlessEqual(IndivoAccount.DEFAULT().account_id, account.account_id)
+        self.failUnlessEqual(self.fake_client.calls, ['account_info'])
+
+        # revalidated once the cached id is too old
+        IndivoModel.manager.default_account_checked = 0
+        IndivoAccount.DEFAULT()
+        self.failUnlessEqual(self.fake_client.calls, ['account_info', 'account_info'])
+
+class AsyncTest(IndivoModelTestCase):
+    def test_many_calls_from_one_thread(self):
+        manager = IndivoModel.manager
+        futures = [manager.make_api_call_async('read_record', record_id='r%s'%i) for i in range(50)]
+        results = IndivoFuture.gather(futures)
+        self.failUnlessEqual([status for status, data in results], [200] * 50)
+        self.failUnlessEqual(self.fake_client.calls, ['read_record'] * 50)
+
+    def test_errors_are_raised_by_result(self):
+        future = IndivoModel.manager.make_api_call_async('no_such_call')
+        self.failUnless(isinstance(future.exception(), ValueError))
+        self.assertRaises(ValueError, future.result)
+
+    def test_get_async(self):
+        future = IndivoAccount.get_async('guardian@example.org', summary=True)
+        self.failUnlessEqual(future.result().full_name, 'Guardian')
+
+class RunParallelTest(TestCase):
+    def test_first_error_in_call_order_after_all_finish(self):
+        finished = []
+        def fail_late():
+            time.sleep(0.05)
+            raise ValueError('first')
+        def fail_early():
+            raise KeyError('second')
+        def finish():
+            time.sleep(0.1)
+            finished.append(True)
+        self.assertRaises(ValueError, IndivoModel.manager.run_parallel, [fail_late, fail_early, finish])
+        self.failUnlessEqual(finished, [True])
+
+    def test_deep_fan_out_runs_inline(self):
+        manager = IndivoModel.manager
+        # wider than the pools, so a worker waiting on its own pool would deadlock
+        width = manager.max_workers + 1
+        # depth is how many pools deep the calling thread is
+        def fan_out(depth):
+            if depth == MAX_POOL_DEPTH + 1:
+                return threading.current_thread()
+            children = manager.run_parallel([partial(fan_out, depth + 1)] * width)
+            if depth == MAX_POOL_DEPTH:
+                self.failUnlessEqual(set(children), set([threading.current_thread()]))
+            return children
+
+        results = []
+        thread = threading.Thread(target=lambda: results.append(fan_out(0)))
+        thread.start()
+        thread.join(10)
+        self.failIf(thread.isAlive(), "nested fan-out deadlocked")
+        self.failUnlessEqual(len(results[0]), width)
+
+class IdentityMapTest(IndivoModelTestCase):
+    def test_one_object_per_key(self):
+        IdentityMap.activate()
+        try:
+            account = IndivoAccount.get('guardian@example.org', summary=True)
+            self.failUnless(IndivoAccount.get('guardian@example.org', summary=True) is account)
+            self.failUnlessEqual(account.full_name, 'Guardian')
+        finally:
+            IdentityMap.deactivate()
+        self.failUnlessEqual(self.fake_client.calls, ['account_info'])
+
+    def test_concurrent_lookups_build_once(self):
+        identity_map = IdentityMap()
+        built = []
+        def build():
+            time.sleep(0.05)
+            built.append(object())
+            return built[-1]
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(identity_map.get_or_create('k', build)))
+                   for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.failUnlessEqual(len(built), 1)
+        self.failUnlessEqual(results, built * 5)
+
+    def test_middleware_scopes_map_to_request(self):
+        middleware = IndivoIdentityMapMiddleware()
+        middleware.process_request(None)
+        identity_map = IdentityMap.current()
+        self.failIf(identity_map is None)
+        identity_map.get_or_create('k', lambda: 'stale')
+
+        response = object()
+        self.failUnless(middleware.process_response(None, response) is response)
+        self.failUnless(IdentityMap.current() is None)
+        self.failUnlessEqual(identity_map.get_or_create('k', lambda: 'fresh'), 'fresh')
+
+class UnpagedSearchTest(IndivoModelTestCase):
+    """ Against an Indivo that ignores the paging parameters of record searches. """
+
+    responses = dict(IndivoModelTestCase.responses, record_search=(200, '<Records>%s</Records>'%''.join(
+                '<Record id="r%s" label="Patient %s"/>'%(i, i) for i in range(30))))
+
+    def setUp(self):
+        super(UnpagedSearchTest, self).setUp()
+        self.cache_backup = IndivoModel.manager.cache, IndivoModel.manager.search_paging
+        IndivoModel.manager.cache = None
+        IndivoModel.manager.search_paging = None
+        User.objects.create_superuser('search', 'search@example.org', 'search')
+        self.client.login(username='search', password='search')
+        self.old_page_size = getattr(settings, 'RECORD_SEARCH_PAGE_SIZE', 50)
+        settings.RECORD_SEARCH_PAGE_SIZE = 20
+
+    def tearDown(self):
+        settings.RECORD_SEARCH_PAGE_SIZE = self.old_page_size
+        IndivoModel.manager.cache, IndivoModel.manager.search_paging = self.cache_backup
+        super(UnpagedSearchTest, self).tearDown()
+
+    def test_later_pages_arent_the_first(self):
+        ids = lambda records: [record.record_id for record in records]
+        self.failUnlessEqual(ids(IndivoRecord.search('Patient', offset=20, limit=5)),
+                             ['r20', 'r21', 'r22', 'r23', 'r24'])
+        self.failUnlessEqual(IndivoRecord.search('Patient', offset=50, limit=50), [])
+        self.failUnlessEqual(ids(IndivoRecord.search('Patient', offset=28)), ['r28', 'r29'])
+        self.failUnlessEqual(IndivoModel.manager.search_paging, False)
+
+    def test_streamed_pages_stop(self):
+        first = ''.join(self.client.get('/admin/record/search',
+                                        {'search_string': 'Patient', 'stream': 1}))
+        self.failUnless('page=2&amp;stream=1' in first)
+
+        second = ''.join(self.client.get('/admin/record/search',
+                                         {'search_string': 'Patient', 'stream': 1, 'page': 2}))
+        self.failUnless('/admin/record/r29/' in second)
+        self.failIf('/admin/record/r19/' in second)
+        self.failIf('page=3' in second)
+
+    def test_sync_ends(self):
+        MirroredRecord.objects.create(record_id='gone', label='Gone', synced_at=datetime.datetime(2011, 1, 1))
+
+        # every offset gets the same 30 records back: the second batch brings nothing new,
+        # which isn't a sign the pass saw everything
+        call_command('sync_indivo', batch_size=30, verbosity=0)
+        self.failUnlessEqual(MirroredRecord.objects.count(), 31)
+        self.failUnlessEqual(self.fake_client.calls.count('record_search'), 2)
+
+        # a short batch is
+        call_command('sync_indivo', batch_size=50, verbosity=0)
+        self.failUnlessEqual(MirroredRecord.objects.count(), 30)
+        self.failIf(MirroredRecord.objects.filter(pk='gone').exists())
+
+    def test_empty_sync_keeps_mirror(self):
+        MirroredRecord.objects.create(record_id='kept', label='Kept', synced_at=datetime.datetime(2011, 1, 1))
+        self.fake_client.responses = dict(self.responses, record_search=(200, '<Records/>'))
+        call_command('sync_indivo', batch_size=30, verbosity=0)
+        self.failUnless(MirroredRecord.objects.filter(pk='kept').exists())
+
+class StandInAsyncTest(TestCase):
+    """ The async path against the stand-in Indivo, which answers each call after a delay. """
+
+    def setUp(self):
+        self.app = StandInIndivo(records=20, accounts=16, latency=0.05)
+        manager = IndivoModel.manager
+        self.backup = (manager.pool, manager.cache, manager.search_paging)
+        manager.pool = ClientPool(lambda: StandInClient(self.app), size=16)
+        manager.cache = None
+        manager.search_paging = None
+
+    def tearDown(self):
+        IndivoModel.manager.pool, IndivoModel.manager.cache, IndivoModel.manager.search_paging = self.backup
+
+    def test_calls_overlap(self):
+        account_ids = sorted(self.app.accounts.keys())
+        started = time.time()
+        accounts = IndivoFuture.gather([IndivoAccount.get_async(account_id, summary=True)
+                                        for account_id in account_ids])
+        elapsed = time.time() - started
+        self.failUnlessEqual([account.account_id for account in accounts], account_ids)
+        self.failUnlessEqual(self.app.calls, 16)
+        # one after the other, they'd take 16 x 50ms
+        self.failUnless(elapsed < 0.4, elapsed)
+
+    def test_later_pages_are_paged_by_indivo(self):
+        labels = sorted([record['label'] for record in self.app.records.values()])
+        records = IndivoRecord.search('', offset=10, limit=5)
+        self.failUnlessEqual([record.label for record in records], labels[10:15])
+        self.failUnlessEqual(IndivoModel.manager.search_paging, True)
+
+        # once the manager knows, there's no asking again
+        self.app.reset_calls()
+        IndivoRecord.search('', offset=15, limit=5)
+        self.failUnlessEqual(self.app.calls, 1)
+
+    def test_bulk_runs_on_the_async_pool(self):
+        results = list(run_bulk(lambda record_id: IndivoRecord.get(record_id).label,
+                                sorted(self.app.records.keys())[:8], workers=8))
+        self.failIf([error for item, result, error in results if error])
+        self.failUnlessEqual(self.app.calls, 8)
+
+class SummaryAccountTest(IndivoModelTestCase):
+
+    def test_summary_account_defers_record_list(self):
+        account = IndivoAccount(account_id='guardian@example.org', new=False, summary=True)
+        self.failUnlessEqual(account.full_name, 'Guardian')
+        self.failUnlessEqual(self.fake_client.calls, ['account_info'])
+
+        self.failUnlessEqual(account.owned_records, [])
+        self.failUnlessEqual(self.fake_client.calls, ['account_info', 'get_account_records'])
+
+    def test_record_shares_are_summaries(self):
+        record = IndivoRecord(record_id='r1')
+        self.failUnlessEqual(record.fullshares.keys(), ['guardian@example.org'])
+        self.failIf('get_account_records' in self.fake_client.calls)
+
+class ResponseCacheTest(IndivoModelTestCase):
+    def setUp(self):
+        super(ResponseCacheTest, self).setUp()
+        self.cache_backup = IndivoModel.manager.cache
+        IndivoModel.manager.cache = ResponseCache(LocalCacheBackend(max_entries=100))
+
+    def tearDown(self):
+        IndivoModel.manager.cache = self.cache_backup
+        super(ResponseCacheTest, self).tearDown()
+
+    def test_reads_are_cached(self):
+        IndivoRecord(record_id='r1').fullshares
+        IndivoRecord(record_id='r1').fullshares
+        self.failUnlessEqual(self.fake_client.calls.count('get_shares'), 1)
+
+    def test_writes_invalidate_record(self):
+        IndivoRecord(record_id='r1').fullshares
+        IndivoRecord(record_id='r1').remove_fullshare_with(IndivoAccount(account_id='guardian@example.org'))
+        IndivoRecord(record_id='r1').fullshares
+        self.failUnlessEqual(self.fake_client.calls.count('get_shares'), 2)
+
+    def test_failed_writes_invalidate_record(self):
+        IndivoRecord(record_id='r1').fullshares
+        self.fake_client.responses = dict(self.responses, delete_share=IOError('timed out'))
+        self.failUnlessRaises(IndivoUnavailable, IndivoRecord(record_id='r1').remove_fullshare_with,
+                              IndivoAccount(account_id='guardian@example.org'))
+        IndivoRecord(record_id='r1').fullshares
+        self.failUnlessEqual(self.fake_client.calls.count('get_shares'), 2)
+
+    def test_lru_eviction(self):
+        backend = LocalCacheBackend(max_entries=2)
+        backend.set('a', 1)
+        backend.set('b', 2)
+        backend.get('a')
+        backend.set('c', 3)
+        self.failUnlessEqual(backend.get('b'), None)
+        self.failUnlessEqual(backend.get('a'), 1)
+
+class FakeRequest(object):
+    def __init__(self, session):
+        self.session = session
+
+class RecentRecordsTest(TestCase):
+    def test_most_recent_first_and_bounded(self):
+        request = FakeRequest({})
+        for i in range(15):
+            add_recent_record(request, IndivoRecord(record_id='r%s'%i, label='Record %s'%i))
+        add_recent_record(request, IndivoRecord(record_id='r5', label='Record 5'))
+
+        recents = get_recent_records(request)
+        self.failUnlessEqual(len(recents), 10)
+        self.failUnlessEqual(recents[0], ('r5', 'Record 5'))
+        self.failUnlessEqual(recents[1], ('r14', 'Record 14'))
+
+    def test_old_sessions_are_ignored(self):
+        request = FakeRequest({'recent_records': set([IndivoRecord(record_id='r1', label='Old')])})
+        self.failUnlessEqual(get_recent_records(request), [])
+        request = FakeRequest({'recent_records': [IndivoRecord(record_id='r1', label='Old'), ('r2', 'New')]})
+        self.failUnlessEqual(get_recent_records(request), [('r2', 'New')])
+
+    def test_only_strings_are_stored(self):
+        request = FakeRequest({})
+        add_recent_record(request, IndivoRecord(record_id='r1', label='Record 1'))
+        self.failUnlessEqual([map(type, entry) for entry in request.session['recent_records']],
+                             [[unicode, unicode]])
+
+class ResponseParsingTest(TestCase):
+    def test_iter_elements(self):
+        xml = '<Records><Record id="r1" label="One"/><Record id="r2" label="Two"/></Records>'
+        self.failUnlessEqual([r.get('id') for r in iter_elements(xml, 'Record')], ['r1', 'r2'])
+
+    def test_is_xml(self):
+        self.failUnless(is_xml('  <Record id="r1"/>'))
+        self.failIf(is_xml('account already exists'))
+        self.failIf(is_xml('<html/>', content_type='text/plain'))
+
+class ContactTest(TestCase):
+    contact_xml = """<Contact xmlns="http://indivo.org/vocab/xml/documents#">
+                       <name><fullName>Jane Doe</fullName><givenName>Jane</givenName></name>
+                       <email type="personal"><emailAddress>jane@example.org</emailAddress></email>
+                       <email type="work"><emailAddress>jdoe@example.org</emailAddress></email>
+                       <address type="home"><region/></address>
+                       <phoneNumber type="home">555-1234</phoneNumber>
+                       <phoneNumber type="work">555-4321</phoneNumber>
+                     </Contact>"""
+
+    def test_from_xml(self):
+        contact = IndivoContact.from_xml(self.contact_xml)
+        self.failUnlessEqual(contact.full_name, 'Jane Doe')
+        self.failUnlessEqual(contact.given_name, 'Jane')
+        self.failUnlessEqual(contact.family_name, None)
+        self.failUnlessEqual(contact.email, 'jane@example.org')
+        self.failUnlessEqual(contact.region, '')
+        self.failUnlessEqual(contact.phone_numbers, ['555-1234', '555-4321'])
+
+    def test_to_xml_matches_template(self):
+        contact = IndivoContact({'full_name': u'Jane & <Doe>', 'email': 'jane@example.org', 
+                                 'phone_numbers': ['555-1234', '555-4321']})
+        canonical = lambda xml: etree.tostring(etree.XML(xml.encode('utf-8')), method='c14n')
+        rendered = get_template('contact.xml').render(Context({'contact': contact}))
+        self.failUnlessEqual(canonical(contact.to_xml()), canonical(rendered))
+        self.failUnlessEqual(IndivoContact.from_xml(contact.to_xml().encode('utf-8')).full_name,
+                             u'Jane & <Doe>')
+
+    def test_control_characters_are_left_out(self):
+        contact = IndivoContact({'full_name': u'Jane\x07 Doe\x1b', 'phone_numbers': [u'555\x00-1234']})
+        parsed = IndivoContact.from_xml(contact.to_xml().encode('utf-8'))
+        self.failUnlessEqual(parsed.full_name, u'Jane Doe')
+        self.failUnlessEqual(parsed.phone_numbers, [u'555-1234'])
+
+class PrefixIndexTest(TestCase):
+    def test_prefix_search(self):
+        index = PrefixIndex()
+        index.add('r1', 'Jane Doe')
+        index.add('r2', 'jane Smith')
+        index.add('r3', 'John Doe')
+        self.failUnlessEqual(index.search('jan'), [('r1', 'Jane Doe'), ('r2', 'jane Smith')])
+        self.failUnlessEqual(index.search('Jo'), [('r3', 'John Doe')])
+        self.failUnlessEqual(index.search('x'), [])
+
+    def test_relabel_and_eviction(self):
+        index = PrefixIndex(max_entries=2)
+        index.add('r1', 'Jane Doe')
+        index.add('r1', 'Janet Doe')
+        index.add('r2', 'John Doe')
+        index.add('r3', 'Jack Doe')
+        self.failUnlessEqual(len(index), 2)
+        self.failUnlessEqual(index.search('ja'), [('r3', 'Jack Doe')])
+
+    def test_typeahead_view(self):
+        User.objects.create_user('typeahead', 'typeahead@example.org', 'typeahead')
+        self.client.login(username='typeahead', password='typeahead')
+        record_index.add('typeahead-r1', 'Zebedee Typeahead')
+        try:
+            response = self.client.get('/admin/record/typeahead', {'q': 'zebedee'})
+        finally:
+            record_index.remove('typeahead-r1')
+        self.failUnlessEqual(response['Content-Type'], 'application/json')
+        self.failUnlessEqual(simplejson.loads(response.content),
+                             [{'record_id': 'typeahead-r1', 'label': 'Zebedee Typeahead'}])
+
+class MirrorTest(IndivoModelTestCase):
+    responses = dict(IndivoModelTestCase.responses, create_share=(200, ''), set_record_owner=(200, ''))
+
+    def test_save_and_search(self):
+        graph = mirror.fetch_record_graph(IndivoRecord(record_id='r1'))
+        mirror.save_record_graphs([graph])
+        mirror.save_record_graphs([graph])
+        self.failUnlessEqual(MirroredRecord.objects.get(pk='r1').label, 'Jane Doe')
+        self.failUnlessEqual(sorted(MirroredShare.objects.values_list('kind', flat=True)),
+                             [MirroredShare.FULL, MirroredShare.OWNER])
+
+        calls = len(self.fake_client.calls)
+        records = IndivoRecord.search('jane', from_mirror=True)
+        self.failUnlessEqual([(r.record_id, r.label) for r in records], [('r1', 'Jane Doe')])
+        self.failUnlessEqual(len(self.fake_client.calls), calls)
+        self.failUnlessEqual(IndivoRecord.search('doe', from_mirror=True), [])
+
+    def test_writes_are_mirrored(self):
+        mirror.save_record_graphs([mirror.fetch_record_graph(IndivoRecord(record_id='r1'))])
+        shares = lambda: sorted(MirroredShare.objects.values_list('account', 'kind'))
+        old_setting = settings.INDIVO_READ_FROM_MIRROR
+        settings.INDIVO_READ_FROM_MIRROR = True
+        try:
+            record = IndivoRecord(record_id='r1')
+            record.create_fullshare_with(IndivoAccount(account_id='nurse@example.org', full_name='Nurse'))
+            record.set_owner(IndivoAccount(account_id='nurse@example.org'))
+            record.remove_fullshare_with(IndivoAccount(account_id='guardian@example.org'))
+        finally:
+            settings.INDIVO_READ_FROM_MIRROR = old_setting
+        self.failUnlessEqual(shares(), [('nurse@example.org', MirroredShare.FULL),
+                                        ('nurse@example.org', MirroredShare.OWNER)])
+        self.failUnlessEqual(mirror.search_accounts(full_name='nurse')[0].account_id, 'nurse@example.org')
+
+class BulkTest(TestCase):
+    def test_run_bulk(self):
+        def half(n):
+            if n % 2:
+                raise ValueError(n)
+            return n / 2
+        results = sorted(run_bulk(half, xrange(10), workers=3))
+        self.failUnlessEqual([(n, result) for n, result, error in results if not error],
+                             [(0, 0), (2, 1), (4, 2), (6, 3), (8, 4)])
+        self.failUnlessEqual([n for n, result, error in results if error], [1, 3, 5, 7, 9])
+
+    def test_checkpoint_resumes(self):
+        import os, tempfile
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            checkpoint = Checkpoint(path)
+            checkpoint.save(1, 'r1', 'created')
+            checkpoint.save(1, 'r1', 'owned')
+            checkpoint.save(2, 'r2', 'created')
+            checkpoint.close()
+
+            checkpoint = Checkpoint(path)
+            self.failUnlessEqual(checkpoint.get(1), ('r1', 'owned'))
+            self.failUnlessEqual(checkpoint.get(2), ('r2', 'created'))
+            self.failUnlessEqual(checkpoint.get(3), None)
+            checkpoint.close()
+        finally:
+            os.remove(path)
+
+class BulkShareTest(IndivoModelTestCase):
+    def test_revoke_is_one_call_per_pair(self):
+        results = list(change_shares(['r1', 'r2'], ['a@example.org', 'b@example.org'], revoke=True))
+        self.failUnlessEqual(sorted([pair for pair, result, error in results if not error]),
+                             [('r1', 'a@example.org'), ('r1', 'b@example.org'),
+                              ('r2', 'a@example.org'), ('r2', 'b@example.org')])
+        self.failUnlessEqual(self.fake_client.calls, ['delete_share'] * 4)
+
+    def test_workers_share_request_stats(self):
+        request_stats = RequestStats.activate()
+        try:
+            list(change_shares(['r1', 'r2'], ['a@example.org'], revoke=True, workers=2))
+        finally:
+            RequestStats.deactivate()
+        self.failUnlessEqual(request_stats.count, 2)
+
+    def test_web_limit(self):
+        form = BulkShareForm({'record_ids': ' '.join(['r%s'%i for i in range(11)]),
+                              'account_ids': ' '.join(['a%s'%i for i in range(10)]),
+                              'action': 'grant'})
+        self.failIf(form.is_valid())
+        self.failUnless('share_records' in unicode(form.non_field_errors()))
+
+class ViewFanOutTest(TestCase):
+    """ The number of Indivo API calls each main view makes, against a stand-in Indivo.
+
+    If one of these goes up, a change has added calls to the view: check it's meant to.
+
+    """
+
+    def setUp(self):
+        self.app = StandInIndivo(records=20, accounts=10)
+        manager = IndivoModel.manager
+        self.backup = (manager.pool, manager.cache, manager.default_account_id)
+        manager.pool = ClientPool(lambda: StandInClient(self.app))
+        manager.cache = None
+        manager.default_account_id = None
+        User.objects.create_superuser('fanout', 'fanout@example.org', 'fanout')
+        self.client.login(username='fanout', password='fanout')
+
+    def tearDown(self):
+        manager = IndivoModel.manager
+        manager.pool, manager.cache, manager.default_account_id = self.backup
+
+    def calls_for(self, method, path, data={}):
+        self.app.reset_calls()
+        response = getattr(self.client, method)(path, data)
+        self.failUnless(response.status_code in (200, 302))
+        return self.app.calls
+
+    def test_fan_out(self):
+        # contact, owner + its info, shares + 2 accounts' info, carenets + 2 carenets' 
+        # members + 4 members' info
+        self.failUnlessEqual(self.calls_for('get', '/admin/record/r3/'), 13)
+        self.failUnlessEqual(self.calls_for('get', '/admin/account/account3@example.org/'), 2)
+        self.failUnlessEqual(self.calls_for('get', '/admin/record/search', {'search_string': 'Ada'}), 1)
+
+        record = {'full_name': 'New Patient', 'email': 'new@example.org', 'street_address': '1 Main St.',
+                  'postal_code': '02115', 'country': 'USA', 'phone_number': ''}
+        self.calls_for('post', '/admin/record/', record)
+        self.failUnlessEqual(self.calls_for('post', '/admin/record/', record), 2)
+
+    def test_call_stats(self):
+        call_stats.reset()
+        response = self.client.get('/admin/record/r3/')
+        self.failUnlessEqual(response['X-Indivo-Calls'], '13')
+        self.failUnless(response['Server-Timing'].startswith('indivo;desc="Indivo API (13 calls)"'))
+
+        calls = dict([(call['name'], call) for call in call_stats.calls()])
+        self.failUnlessEqual(calls['account_info']['count'], 7)
+        self.failUnlessEqual(calls['get_shares']['statuses'], [(200, 1)])
+        self.failUnlessEqual([(view['name'], view['max_calls']) for view in call_stats.views()],
+                             [('admin_record_show', 13)])
+        self.failUnlessEqual(self.client.get('/admin/stats/').status_code, 200)
+
+class PercentileTest(TestCase):
+    def test_nearest_rank(self):
+        values = range(1, 101)
+        self.failUnlessEqual([percentile(values, p) for p in (50, 95, 99, 100)], [50, 95, 99, 100])
+        self.failUnlessEqual(percentile([7], 99), 7)
+        self.failUnlessEqual(percentile([], 50), None)
+
+class FlakyIndivoClient(object):
+    """ Fails each call with the next of a list of outcomes: a status, an exception or a delay. """
+
+    def __init__(self, outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = []
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        def api_call(*args, **kwargs):
+            self.calls.append(name)
+            outcome = self.outcomes.pop(0) if self.outcomes else 200
+            if isinstance(outcome, Exception):
+                raise outcome
+            if isinstance(outcome, float):
+                time.sleep(outcome)
+                outcome = 200
+            return {'response_status': outcome, 'response_data': '<Record id="r1" label="x"/>'}
+        return api_call
+
+class ResilienceTest(TestCase):
+    def setUp(self):
+        manager = IndivoModel.manager
+        self.backup = (manager.pool, manager.cache, manager.breaker, manager.timeout, 
+                       manager.retry_backoff)
+        manager.cache = None
+        manager.breaker = CircuitBreaker(failure_threshold=3, reset_after=60)
+        manager.retry_backoff = 0.001
+
+    def tearDown(self):
+        manager = IndivoModel.manager
+        manager.pool, manager.cache, manager.breaker, manager.timeout, manager.retry_backoff = self.backup
+
+    def use_client(self, *outcomes):
+        self.client = FlakyIndivoClient(outcomes)
+        IndivoModel.manager.pool = ClientPool(lambda: self.client)
+
+    def test_reads_are_retried(self):
+        self.use_client(503, IOError('connection refused'))
+        status, data = IndivoModel.manager.make_api_call('read_record', record_id='r1')
+        self.failUnlessEqual(status, 200)
+        self.failUnlessEqual(self.client.calls, ['read_record'] * 3)
+
+    def test_writes_are_not_retried(self):
+        self.use_client(503)
+        status, data = IndivoModel.manager.make_api_call('create_share', record_id='r1', data={})
+        self.failUnlessEqual(status, 503)
+        self.failUnlessEqual(self.client.calls, ['create_share'])
+
+    def test_deadline(self):
+        IndivoModel.manager.timeout = 0.02
+        self.use_client(0.1)
+        self.assertRaises(IndivoTimeout, IndivoModel.manager.make_api_call, 'create_record', data='')
+
+    def test_breaker_fails_fast_then_probes(self):
+        self.use_client(*[IOError('connection refused')] * 9)
+        manager = IndivoModel.manager
+        for i in range(3):
+            # one failure per call, however many attempts it made
+            self.failUnlessEqual(manager.breaker.state, CircuitBreaker.CLOSED)
+            self.assertRaises(IndivoUnavailable, manager.make_api_call, 'read_record', record_id='r%s'%i)
+        self.failUnlessEqual(manager.breaker.state, CircuitBreaker.OPEN)
+        self.assertRaises(IndivoUnavailable, manager.make_api_call, 'read_record', record_id='r1')
+        self.failUnlessEqual(len(self.client.calls), 9)
+
+        # once the reset time is up, a successful probe closes the breaker
+        manager.breaker.opened_at -= 60
+        status, data = manager.make_api_call('read_record', record_id='r1')
+        self.failUnlessEqual(manager.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_probe_raising_anything_reopens(self):
+        self.use_client(KeyError('response_status'))
+        manager = IndivoModel.manager
+        for i in range(3):
+            manager.breaker.record_failure()
+        manager.breaker.opened_at -= 60
+        self.assertRaises(KeyError, manager.make_api_call, 'create_share', record_id='r1', data={})
+        self.failUnlessEqual(manager.breaker.state, CircuitBreaker.OPEN)
+
+        manager.breaker.opened_at -= 60
+        manager.make_api_call('create_share', record_id='r1', data={})
+        self.failUnlessEqual(manager.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_socket_timeout(self):
+        self.use_client(socket.timeout('timed out'))
+        self.assertRaises(IndivoTimeout, IndivoModel.manager.make_api_call, 'create_share',
+                          record_id='r1', data={})
+
+    def test_record_create_resolves_owner_first(self):
+        User.objects.create_user('resilience', 'resilience@example.org', 'resilience')
+        browser = self.client
+        browser.login(username='resilience', password='resilience')
+        self.use_client(*[IOError('connection refused')] * 3)
+        manager = IndivoModel.manager
+        default_account_id, manager.default_account_id = manager.default_account_id, None
+        try:
+            response = browser.post('/admin/record/', {'full_name': 'New Patient', 'email': 'new@example.org',
+                                                       'street_address': '1 Main St.', 'postal_code': '02115',
+                                                       'country': 'USA', 'phone_number': ''})
+        finally:
+            manager.default_account_id = default_account_id
+        self.failUnlessEqual(response.status_code, 503)
+        self.failUnlessEqual(self.client.calls, ['account_info'] * 3)
+
+    def test_busy_pool_is_unavailable(self):
+        pool = ClientPool(lambda: object(), max_in_use=1, timeout=0.01)
+        with pool.client():
+            self.assertRaises(IndivoUnavailable, pool.acquire)
+
+    def test_busy_pool_doesnt_send_late(self):
+        self.use_client()
+        manager = IndivoModel.manager
+        manager.timeout = 0.2
+        manager.pool = ClientPool(lambda: self.client, max_in_use=1, timeout=0.05)
+        with manager.pool.client():
+            self.assertRaises(ClientPoolTimeout, manager.make_api_call, 'create_share', 
+                              record_id='r1', data={})
+        time.sleep(0.05)
+        self.failUnlessEqual(self.client.calls, [])
+        # waiting on our own pool says nothing about Indivo
+        self.failUnlessEqual(manager.breaker.failures, 0)
+
+    def test_deadline_starts_when_sent(self):
+        self.use_client(0.1)
+        manager = IndivoModel.manager
+        manager.timeout = 0.2
+        manager.pool = ClientPool(lambda: self.client, max_in_use=1, timeout=1)
+        client = manager.pool.acquire()
+        threading.Timer(0.2, manager.pool.release, (client,)).start()
+        status, data = manager.make_api_call('create_share', record_id='r1', data={})
+        self.failUnlessEqual(status, 200)
+
+    def test_abandoned_call_isnt_sent(self):
+        self.use_client()
+        manager = IndivoModel.manager
+        dispatch = _Dispatch()
+        self.failUnless(dispatch.abandon())
+        self.failUnlessEqual(manager._send(dispatch, self.client, 'create_share', (), {}), None)
+        self.failUnlessEqual(self.client.calls, [])
+
+    def test_error_page(self):
+        User.objects.create_user('resilience', 'resilience@example.org', 'resilience')
+        self.client.login(username='resilience', password='resilience')
+        IndivoModel.manager.breaker.record_failure()
+        IndivoModel.manager.breaker.record_failure()
+        IndivoModel.manager.breaker.record_failure()
+        response = self.client.get('/admin/record/r1/')
+        self.failUnlessEqual(response.status_code, 503)
+        self.failUnless(int(response['Retry-After']) > 0)
+
+class SingleFlightTest(ResilienceTest):
+    def test_concurrent_reads_share_a_request(self):
+        self.use_client(0.1)
+        manager = IndivoModel.manager
+        read = partial(manager.make_api_call, 'read_record', record_id='r1')
+        results = manager.run_parallel([read, read, read])
+        self.failUnlessEqual(self.client.calls, ['read_record'])
+        self.failUnless(results[0][1] is results[2][1])
+
+    def test_writes_are_not_shared(self):
+        self.use_client(0.05, 0.05)
+        manager = IndivoModel.manager
+        write = partial(manager.make_api_call, 'create_share', record_id='r1', data={})
+        manager.run_parallel([write, write])
+        self.failUnlessEqual(self.client.calls, ['create_share', 'create_share'])
+
+class UserListTest(TestCase):
+    def setUp(self):
+        User.objects.create_superuser('admin', 'admin@example.org', 'admin')
+        for i in range(5):
+            User.objects.create_user('staff%s'%i, 'staff%s@ward.example.org'%i, 'staff')
+        User.objects.filter(username='staff4').update(is_active=False)
+        self.client.login(username='admin', password='admin')
+        self.old_page_size = getattr(settings, 'USERS_PAGE_SIZE', 50)
+        settings.USERS_PAGE_SIZE = 2
+
+    def tearDown(self):
+        settings.USERS_PAGE_SIZE = self.old_page_size
+
+    def usernames(self, response):
+        return [u.username for u in response.context['users']]
+
+    def test_pages_and_filters(self):
+        response = self.client.get('/admin/users/')
+        self.failUnlessEqual(self.usernames(response), ['admin', 'staff0'])
+        self.failUnlessEqual(response.context['next_page'], 2)
+
+        response = self.client.get('/admin/users/', {'email': 'staff', 'active': '1', 'page': 2})
+        self.failUnlessEqual(self.usernames(response), ['staff2', 'staff3'])
+        self.failUnlessEqual(response.context['next_page'], None)
+        self.failUnlessEqual(response.context['filter_query'], 'active=1&email=staff')
+
+        response = self.client.get('/admin/users/', {'username': 'STAFF', 'active': '0'})
+        self.failUnlessEqual(self.usernames(response), ['staff4'])
+
+    def test_indexes(self):
+        self.failUnless(index_exists('auth_user', 'auth_user_active_username'))
+        # already there: not created again
+        create_user_indexes(sender=None, verbosity=0)
+        self.failIf(index_exists('auth_user', 'no_such_index'))
+
+    def test_create_errors_dont_list_users(self):
+        response = self.client.post('/admin/users/', {'username': 'staff0'})
+        self.failUnlessEqual(response.status_code, 200)
+        self.failIf('users' in response.context)
+        self.failUnless(response.context['user_form'].errors)
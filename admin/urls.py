@@ -17,8 +17,11 @@ urlpatterns = patterns('',
     (r'^record/(?P<record_id>[^/]+)/owner$', MethodDispatcher({'GET': admin_record_owner_form, 'POST': admin_record_owner})),
     (r'^record/(?P<record_id>[^/]+)/owner/(?P<account_id>[^/]+)/$', MethodDispatcher({'POST': admin_record_account_owner_set})),
     (r'^record/search$', MethodDispatcher({'GET': admin_record_search})),
+    (r'^record/typeahead$', MethodDispatcher({'GET': admin_record_typeahead})),
+    (r'^shares/bulk$', MethodDispatcher({'GET': admin_share_bulk_form, 'POST': admin_share_bulk})),
     (r'^account/(?P<account_id>[^/]+)/$', MethodDispatcher({'GET': admin_account_show})),
     (r'^account/(?P<account_id>[^/]+)/retire$', MethodDispatcher({'POST': admin_account_retire})),
+    (r'^stats/$', MethodDispatcher({'GET': admin_stats, 'POST': admin_stats})),
     (r'^users/$', MethodDispatcher({'GET':admin_users_show,
                                     'POST':admin_user_create,})),
     (r'^users/(?P<user_id>[^/]+)/edit/$', 
@@ -4,11 +4,20 @@ Indivo Admin views
 
 from django.contrib.auth.models import User
 from django.contrib.auth.decorators import login_required, user_passes_test
+from django.conf import settings
+from django.http import HttpResponse
 from django.shortcuts import redirect 
+from django.utils import simplejson
+from django.utils.http import urlencode
 from django.template.loader import get_template
-from admin.forms import FullUserForm, FullUserChangeForm, RecordForm, AccountForm
-from admin.lib.indivo import IndivoRecord, IndivoAccount, IndivoContact
-from admin.lib.utils import render_admin_response, get_users_to_manage, append_error_to_form
+from admin.forms import FullUserForm, FullUserChangeForm, RecordForm, AccountForm, BulkShareForm
+from admin.lib.indivo import IndivoModel, IndivoRecord, IndivoAccount, IndivoContact
+from admin.lib.bulk import change_shares
+from admin.lib.stats import call_stats
+from admin.lib.typeahead import record_index
+from admin.lib.utils import render_admin_response, get_users_to_manage, append_error_to_form, add_recent_record, \
+    stream_record_list, get_user_filters
+from functools import partial
 import copy
 
 @login_required()
@@ -17,12 +26,11 @@ def admin_show(request):
 
 @login_required() 
 def admin_record_show(request, record_id):
-    record = IndivoRecord(record_id=record_id)
+    record = IndivoRecord.get(record_id)
+    record.prefetch()
 
     # update recently viewed records
-    recents = request.session.get('recent_records', set())
-    recents.add(record)
-    request.session['recent_records'] = recents
+    add_recent_record(request, record)
 
     # populate form from contact document  TODO: currently only handles single phone number
     contact = record.contact
@@ -61,6 +69,7 @@ def admin_record_create(request):
         contact_obj = IndivoContact(contact_data)
 
         try:
+            # resolve the owner first: if that fails, no record is left in Indivo without one
             default_account = IndivoAccount.DEFAULT()
             record = IndivoRecord.from_contact(contact_obj)
             record.push()
@@ -77,18 +86,44 @@ def admin_record_create(request):
 @login_required()    
 def admin_record_search(request):
     search_string = request.GET['search_string']
-    records = IndivoRecord.search(search_string)
+    page_size = getattr(settings, 'RECORD_SEARCH_PAGE_SIZE', 50)
+    try:
+        page = max(int(request.GET.get('page', 1)), 1)
+    except ValueError:
+        page = 1
+    offset = (page - 1) * page_size
+
+    # ask for one extra record, to find out whether there's a next page
+    if request.GET.get('stream'):
+        records = IndivoRecord.iter_search(search_string, offset=offset, limit=page_size + 1)
+        return HttpResponse(stream_record_list(request, records, search_string, page, page_size))
+
+    records = IndivoRecord.search(search_string, offset=offset, limit=page_size + 1)
+    has_next = len(records) > page_size
+    records = records[:page_size]
 
-    if (len(records) == 1):
+    if (len(records) == 1 and page == 1):
         return redirect('/admin/record/' + records[0].record_id + '/')
     else:
         return render_admin_response(request, 'record_list.html',{
             'records': records,
+            'search_string': search_string,
+            'page': page,
+            'previous_page': page - 1,
+            'next_page': page + 1 if has_next else None,
         })
 
+@login_required()
+def admin_record_typeahead(request):
+    matches = record_index.search(request.GET.get('q', ''),
+                                  limit=getattr(settings, 'RECORD_TYPEAHEAD', {}).get('LIMIT', 10))
+    return HttpResponse(simplejson.dumps([{'record_id':record_id, 'label':label} 
+                                          for record_id, label in matches]),
+                        mimetype='application/json')
+
 @login_required()
 def admin_record_share_form(request, record_id):
-    record = IndivoRecord(record_id=record_id)
+    record = IndivoRecord.get(record_id)
     return render_admin_response(request, 'share_add.html', {
         'account_form': AccountForm(),
         'account_search_form': AccountForm(),
@@ -97,7 +132,7 @@ def admin_record_share_form(request, record_id):
     
 @login_required()
 def admin_record_share_add(request, record_id):
-    record = IndivoRecord(record_id=record_id)
+    record = IndivoRecord.get(record_id)
 
     if request.POST['existing'] == 'False':
         # Create new Account and add Share
@@ -143,8 +178,8 @@ def admin_record_share_add(request, record_id):
 
 @login_required()
 def admin_record_account_share_delete(request, record_id, account_id):
-    record = IndivoRecord(record_id=record_id)
-    account = IndivoAccount(account_id=account_id, new=False)
+    record = IndivoRecord.get(record_id)
+    account = IndivoAccount(account_id=account_id)
     success = record.remove_fullshare_with(account)
     if not success:
         # TODO
@@ -154,8 +189,8 @@ def admin_record_account_share_delete(request, record_id, account_id):
 
 @login_required()
 def admin_record_account_share_add(request, record_id, account_id):
-    record = IndivoRecord(record_id=record_id)
-    account = IndivoAccount(account_id=account_id, new=False)
+    record = IndivoRecord.get(record_id)
+    account = IndivoAccount(account_id=account_id)
     try:
         share = record.create_fullshare_with(account)
     except Exception as e:
@@ -168,12 +203,12 @@ def admin_record_owner_form(request, record_id):
     return render_admin_response(request, 'owner_set.html', {
         'account_form': AccountForm(),
         'account_search_form': AccountForm(),
-        'record': IndivoRecord(record_id=record_id),
+        'record': IndivoRecord.get(record_id),
     })
 
 @login_required()
 def admin_record_owner(request, record_id):
-    record = IndivoRecord(record_id = record_id)
+    record = IndivoRecord.get(record_id)
     
     if request.POST['existing'] == 'False':
 
@@ -221,8 +256,8 @@ def admin_record_owner(request, record_id):
 
 @login_required()
 def admin_record_account_owner_set(request, record_id, account_id):
-    record = IndivoRecord(record_id=record_id)
-    account = IndivoAccount(account_id=account_id, new=False)
+    record = IndivoRecord.get(record_id)
+    account = IndivoAccount(account_id=account_id)
     try:
         record.set_owner(account)
     except Exception as e:
@@ -230,26 +265,87 @@ def admin_record_account_owner_set(request, record_id, account_id):
         raise
     return redirect('/admin/record/' + record_id +'/')
 
+@login_required()
+def admin_share_bulk_form(request):
+    return render_admin_response(request, 'share_bulk.html', {
+        'share_form': BulkShareForm(),
+    })
+
+@login_required()
+def admin_share_bulk(request):
+    form = BulkShareForm(request.POST)
+    if not form.is_valid():
+        return render_admin_response(request, 'share_bulk.html', {
+            'share_form': form,
+        })
+
+    record_ids = form.cleaned_data['record_ids']
+    account_ids = form.cleaned_data['account_ids']
+    errors = {}
+    for pair, result, error in change_shares(record_ids, account_ids,
+                                             revoke=form.cleaned_data['action'] == 'revoke',
+                                             workers=IndivoModel.manager.max_workers):
+        errors[pair] = error
+
+    # reload each record once, all at the same time, to show its shares as they are now
+    records = IndivoModel.manager.run_parallel([partial(_reload_shares, record_id) 
+                                                for record_id in record_ids])
+    results = []
+    for record_id, record in zip(record_ids, records):
+        results.append((record_id, record, [(account_id, errors.get((record_id, account_id)))
+                                            for account_id in account_ids]))
+
+    return render_admin_response(request, 'share_bulk.html', {
+        'share_form': form,
+        'action': form.cleaned_data['action'],
+        'results': results,
+        'failures': len([error for error in errors.values() if error]),
+    })
+
+def _reload_shares(record_id):
+    """ Fetch a record's label and full shares, or None if it can't be read. """
+    record = IndivoRecord.get(record_id)
+    try:
+        record.manager.run_parallel([lambda: record.label, lambda: record.fullshares])
+    except ValueError:
+        return None
+    return record
+
 @login_required()    
 def admin_account_show(request, account_id):
-    account = IndivoAccount(account_id=account_id, new=False)
+    account = IndivoAccount.get(account_id)
     return render_admin_response(request, 'account.html', {
         'account': account
     }) 
 
 @login_required()
 def admin_account_retire(request, account_id):
-    account = IndivoAccount(account_id=account_id, new=False)
+    account = IndivoAccount.get(account_id)
     account.retire()
     return redirect('/admin/account/' + account_id + '/')
 
 @login_required()
 @user_passes_test(lambda u: u.is_superuser, login_url='/admin/')
 def admin_users_show(request):
-    return render_admin_response(request, 
-                                       'user_list.html', 
-                                       {'users':get_users_to_manage(request),
-                                        'user_form':FullUserForm(),})
+    page_size = getattr(settings, 'USERS_PAGE_SIZE', 50)
+    try:
+        page = max(int(request.GET.get('page', 1)), 1)
+    except ValueError:
+        page = 1
+    offset = (page - 1) * page_size
+
+    # ask for one extra user, to find out whether there's a next page
+    users = list(get_users_to_manage(request)[offset:offset + page_size + 1])
+    filters = get_user_filters(request)
+    return render_admin_response(request, 'user_list.html', {
+        'users': users[:page_size],
+        'filters': filters,
+        'filter_query': urlencode(sorted((name, value) for name, value in filters.items() if value)),
+        'page': page,
+        'previous_page': page - 1,
+        'next_page': page + 1 if len(users) > page_size else None,
+        'user_form': FullUserForm(),
+    })
 
 @login_required()
 @user_passes_test(lambda u: u.is_superuser, login_url='/admin/')
@@ -259,10 +355,8 @@ def admin_user_create(request):
         form.save()
         return redirect('/admin/users/')
     except ValueError:
-        return render_admin_response(request, 
-                                           'user_list.html', 
-                                           {'users':get_users_to_manage(request),
-                                            'user_form':form,})
+        # just the form: there's no need to list the users again to show its errors
+        return render_admin_response(request, 'user_create.html', {'user_form':form,})
     except Exception as e:
         # TODO
         raise
@@ -328,3 +422,17 @@ def admin_user_activate(request, user_id):
     except Exception as e:
         # TODO
         raise
+
+@login_required()
+@user_passes_test(lambda u: u.is_superuser, login_url='/admin/')
+def admin_stats(request):
+    if request.method == 'POST':
+        call_stats.reset()
+        return redirect('/admin/stats/')
+    return render_admin_response(request, 'stats.html', {
+        'calls': call_stats.calls(),
+        'views': call_stats.views(),
+        'pool': IndivoModel.manager.pool.stats(),
+        'breaker': IndivoModel.manager.breaker.stats(),
+        'coalesced': IndivoModel.manager.flights.coalesced,
+    })